@@ -1,6 +1,63 @@
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+
 import sqlglot
 import sqlglot.expressions as exp
 
+# NumPy (and PyArrow for Parquet files) are only needed to estimate from data files with --data
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+# Static selectivity guesses used when there is no feedback for a predicate
+KEY_EQUALITY_SELECTIVITY = 0.001
+PARTIAL_KEY_EQUALITY_SELECTIVITY = 0.05
+EQUALITY_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 0.3
+NOT_EQUAL_SELECTIVITY = 0.9
+DEFAULT_SELECTIVITY = 0.5
+
+# Learned selectivities are kept in this SQLite file. An observation's weight halves every
+# FEEDBACK_HALF_LIFE seconds and it is ignored once it falls below MIN_FEEDBACK_WEIGHT
+FEEDBACK_FILE = "selectivity_feedback.db"
+FEEDBACK_HALF_LIFE = 7 * 24 * 60 * 60
+MIN_FEEDBACK_WEIGHT = 0.5
+
+# Data files are sampled down to SAMPLE_SIZE rows, and join attributes to about CORRELATED_SAMPLE_SIZE
+# values. The samples are cached in SAMPLE_DIRECTORY inside the data directory
+SAMPLE_SIZE = 1000
+CORRELATED_SAMPLE_SIZE = 1000
+SAMPLE_DIRECTORY = ".samples"
+
+# The budget of the query being optimized in each thread, see Budget
+ACTIVE_BUDGET = threading.local()
+
+# Tables without ROWS(n) in the schema are assumed to have this many rows, and tables
+# missing from the schema this many attributes
+DEFAULT_TABLE_ROWS = 1000
+DEFAULT_TABLE_WIDTH = 10
+
+# The optimization steps that are costed, and how much worse (as a fraction) a query's
+# final cost may get before --check-costs fails
+COST_STAGES = ["canonical", "cascade", "pushdown", "selectivity", "joins", "projections"]
+COST_REGRESSION_THRESHOLD = 0.1
+
 
 # Tree node logic
 class Node:
@@ -25,26 +82,102 @@ class Node:
             child_node.parent = None
         return
     
-    # Inserts the node into the tree
+    # Inserts the node into the tree above the child node, taking the child's place among its siblings
+    # so the inputs of a join keep their order
     def insert_node(self, parent_node, child_node):
+        index = parent_node.children.index(child_node)
         parent_node.remove_child(child_node)
-        parent_node.add_child(self)
+        parent_node.children.insert(index, self)
+        self.parent = parent_node
         self.add_child(child_node)
         return
 
 
+# Raised when an optimization step runs out of its budget
+class BudgetExceeded(Exception):
+    pass
+
+
+# Limits on the optimization of one query, a limit of None is not enforced.
+# milliseconds is the time since the budget was created, nodes the number of tree nodes
+# the steps may visit and memory the number of bytes that may be allocated
+class Budget:
+    # Create the budget and start counting
+    def __init__(self, milliseconds=None, nodes=None, memory=None):
+        self.milliseconds = milliseconds
+        self.nodes = nodes
+        self.memory = memory
+        self.explored = 0
+        # The step that ran out of budget, None while the budget holds
+        self.exceeded = None
+        self.started_tracing = False
+        if memory is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.start_memory = tracemalloc.get_traced_memory()[0] if memory is not None else 0
+        self.start = time.perf_counter()
+        return
+
+    # Counts one explored node and raises BudgetExceeded once any limit is passed
+    def spend(self):
+        self.explored += 1
+        if self.nodes is not None and self.explored > self.nodes:
+            raise BudgetExceeded("nodes")
+        if self.milliseconds is not None and (time.perf_counter() - self.start) * 1000 > self.milliseconds:
+            raise BudgetExceeded("time")
+        if self.memory is not None and tracemalloc.get_traced_memory()[0] - self.start_memory > self.memory:
+            raise BudgetExceeded("memory")
+        return
+
+    # Stops the memory tracing this budget started
+    def close(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+        return
+
+
+# Sets the budget the optimization steps in this thread spend from and returns the previous one
+def set_active_budget(budget):
+    previous = getattr(ACTIVE_BUDGET, "budget", None)
+    ACTIVE_BUDGET.budget = budget
+    return previous
+
+
+# Called by the optimization steps for every node they visit
+def spend_budget():
+    budget = getattr(ACTIVE_BUDGET, "budget", None)
+    if budget is not None:
+        budget.spend()
+    return
+
+
+# Returns a copy of the tree below a node. The data is shared, the steps replace it rather than change it
+def copy_tree(tree_node):
+    root = Node(tree_node.data)
+    stack = [(tree_node, root)]
+    while stack:
+        old_node, new_node = stack.pop()
+        for child_node in old_node.children:
+            new_child = Node(child_node.data)
+            new_node.add_child(new_child)
+            stack.append((child_node, new_child))
+    return root
+
+
+# Returns True if the node belongs to the given query block and not to a nested subquery
+def in_block(node, block):
+    return node.find_ancestor(exp.Select) is block
+
+
 # Used to find the projecitons for the canonical query tree 
 def find_projection(expression):
-    select_clauses = expression.find_all(exp.Select)
     projections = []
 
     projections.append("PROJECTION")
 
-    # Iterate through the found Select expressions (there should typically be one for a single query)
-    for select_clause in select_clauses:
-        # You can access the expressions within the SELECT clause
-        for projection in select_clause.expressions:
-            projections.append(projection.sql())
+    # Only the block's own SELECT list, nested query blocks are planned separately
+    for projection in expression.expressions:
+        projections.append(projection.sql())
     
     projections = " ".join(projections)
 
@@ -57,7 +190,8 @@ def find_joins(expression):
 
     # Iterate through the found Select expressions (there should typically be one for a single query)
     for join_clause in join_clauses:
-        joins.append(join_clause.sql())
+        if in_block(join_clause, expression):
+            joins.append(join_clause.sql())
 
     return joins
 
@@ -66,9 +200,10 @@ def find_joins(expression):
 def find_tables(expression):
     tables = []
 
-    # Find all Table use in the original SQL query
+    # Find all Table use in the original SQL query, tables inside subqueries belong to their own tree
     for table in expression.find_all(exp.Table):
-        tables.append(table.sql())
+        if in_block(table, expression):
+            tables.append(table.sql())
     
     return tables
 
@@ -86,8 +221,9 @@ def build_canonical(expression, from_clause):
             new_node = Node(i)
             tree.append(new_node)
             
-    # add cartesian
-    tree.append(Node("X"))
+    # add cartesian, a single table needs no cartesian
+    if len(from_clause) > 1:
+        tree.append(Node("X"))
 
     # handles the from clause
     for i in range(len(from_clause)):
@@ -98,6 +234,11 @@ def build_canonical(expression, from_clause):
             tree.append(Node(f"X"))
 
     # Append the children into the tree
+    if len(from_clause) == 1:
+        for i in range(len(tree) - 1):
+            tree[i].add_child(tree[i+1])
+        return tree
+
     i = 0
     while i < len(tree) - 2:
         if tree[i].data != "X":
@@ -130,18 +271,21 @@ def insert_joins(tree_node, joins_arr):
     return
 
 
-# Function for printing trees
+# Function for printing trees, a stack is used so trees deeper than the recursion limit print too
 def print_tree(tree_node, depth):
-    if tree_node is not None:
-        print("    " * depth, tree_node.data)
-        if tree_node.children != []:
-            for child_node in tree_node.children:
-                print_tree(child_node, depth + 1)
+    stack = [(tree_node, depth)]
+    while stack:
+        tree_node, depth = stack.pop()
+        if tree_node is not None:
+            print("    " * depth, tree_node.data)
+            for child_node in reversed(tree_node.children):
+                stack.append((child_node, depth + 1))
     return
 
 
 # Take in a tree and separate the conjunctive selection conditions
 def cascade_selection(tree_node):
+    spend_budget()
     if not tree_node.children:
         return
 
@@ -157,6 +301,7 @@ def cascade_selection(tree_node):
 
 # Function for finding all leafs in our tree
 def find_leaves(tree_node, leaf_nodes):
+    spend_budget()
     if tree_node is not None:
         if tree_node.children == []:
             leaf_nodes.append(tree_node)
@@ -170,6 +315,7 @@ def find_leaves(tree_node, leaf_nodes):
 # Takes 2 nodes and returns the cartesian product node that joins them
 # IN PROGRESS
 def find_common_cartesian(start, target):
+    spend_budget()
 
     if start == target:
         return target
@@ -183,6 +329,7 @@ def find_common_cartesian(start, target):
 
 # Take in a tree node and push down the selections to an appropiate spot
 def selection_down(tree_node):
+    spend_budget()
     select_statements = []
     leaf_nodes = []
 
@@ -203,7 +350,7 @@ def selection_down(tree_node):
         if i != '':
 
             # Handles selections involving more than one table
-            if select[0][0].isupper and select[0][1] == '.' and select[2][0].isupper and select[2][1] == '.':
+            if select[0][0].isupper and select[0][1] == '.' and len(select[2]) > 1 and select[2][0].isupper and select[2][1] == '.':
 
                 # Finds the two tables being joined
                 node1 = leaf_nodes[0]
@@ -242,8 +389,9 @@ def selection_down(tree_node):
 
 # Checks the tree for any cartesian and selects that need to be switched into joins and returns an updated tree
 def create_joins(tree_node):
+    spend_budget()
     # Check for a select condition with a cartesian child
-    if tree_node is not None and "SELECT" in str(tree_node.data) and tree_node.children[0].data == "X":
+    if tree_node is not None and str(tree_node.data).startswith("SELECT") and tree_node.children[0].data == "X":
         # Update the selct to a join
         tree_node.data = str(tree_node.data).replace("SELECT", "JOIN")
         cart_node = tree_node.children[0]
@@ -264,140 +412,1868 @@ def create_joins(tree_node):
 
 # Adds projections to the query tree in the correct places
 def add_projections(tree_node, dict):
+    spend_budget()
     if "PROJECTION" in str(tree_node.data):
         #Start a new dictionary for projections below this node
         dict = {} 
         #Extract projection attributes from the current PROJECTION node
-        proj = str(tree_node.data).strip().split()[1:]
+        # Attributes inside of aggregates, e.g. AVG(E.Salary), are needed below the projection too
+        proj = find_attributes(tree_node.data)
         for i in proj:
             temp = i.split('.')
             # Append the attribute to the existing string, initializing if necessary
             dict[temp[0]] = dict.setdefault(temp[0], "").strip() + " " + i 
         # Recursively call with the new dict for the child
         # Strip to ensure the value in the dict is clean
-        add_projections(tree_node.children[0], {k: v.strip() for k, v in dict.items()})   
+        add_projections(tree_node.children[0], {k: v.strip() for k, v in dict.items()})
+    elif is_subquery_join(tree_node):
+        # The subquery side already has its own projections, only the outer side is processed
+        proj_dict = {k: v for k, v in dict.items()}
+        for att in join_attributes(tree_node.data):
+            alias = att.split('.')[0]
+            if att not in proj_dict.setdefault(alias, "").split():
+                proj_dict[alias] = (proj_dict[alias] + " " + att).strip()
+        child_node = tree_node.children[0]
+        if "JOIN" in str(child_node.data) or "PROJECTION" in str(child_node.data) or is_subquery_join(child_node):
+            add_projections(child_node, proj_dict)
+        else:
+            leaves = []
+            find_leaves(child_node, leaves)
+            table_alias = find_alias(leaves[0].data)
+            if proj_dict.get(table_alias):
+                attributes = " ".join(sorted(set(proj_dict[table_alias].split())))
+                new_node = Node("PROJECTION " + attributes)
+                new_node.insert_node(tree_node, child_node)
     elif "JOIN" in str(tree_node.data):
-        #Parse the JOIN condition
-        join = str(tree_node.data).strip().split()
-        att1 = join[1].split('.') 
-        att2 = join[3].split('.') 
-        table1_alias = att1[0] 
-        table2_alias = att2[0] 
-        #Initialize projection dictionaries for the two children, inheriting required attributes from above (`dict`)
-        proj_dict1 = {k: v for k, v in dict.items()}
-        proj_dict2 = {k: v for k, v in dict.items()}
-        # Add the join attributes themselves to the required projections for the respective children
-        if join[1] not in proj_dict1.setdefault(table1_alias, ""):
-            proj_dict1[table1_alias] = proj_dict1.setdefault(table1_alias, "") + " " + join[1]
-        if join[3] not in proj_dict2.setdefault(table2_alias, ""):
-            proj_dict2[table2_alias] = proj_dict2.setdefault(table2_alias, "") + " " + join[3]
-        #Process children in reverse order (to avoid index issues during insertion)
-        for child_node in reversed(tree_node.children):
-            table_alias = None
-            current_proj_dict = None
-            # --- Logic to find the leaf table alias under the current child's subtree ---
-            temp_node = child_node
-            # Traverse down until a leaf (table) node is reached
-            while temp_node.children:
-                # If a SELECT is immediately above the table, jump over it
-                if "SELECT" in str(temp_node.data) and temp_node.children:
-                    temp_node = temp_node.children[0]
-                else:
-                    temp_node = temp_node.children[0] 
-            node_data = str(temp_node.data).strip()
-            if ' AS ' in node_data:
-                table_alias = node_data.split(' AS ')[1].strip()
-            # This is a fallback based on your original logic (e.g., last character is the alias)
-            elif node_data and node_data[-1].isalpha(): 
-                table_alias = node_data[-1] 
-            # Assign the correct projection dictionary based on the table alias
-            if table_alias == table1_alias:
-                current_proj_dict = proj_dict1
-            elif table_alias == table2_alias:
-                current_proj_dict = proj_dict2
-            if current_proj_dict is None:
-                current_proj_dict = {} 
-            # Build and insert the PROJECTION node
-            if table_alias in current_proj_dict:
-                # Remove extra spaces and split into unique attributes
-                attributes_list = current_proj_dict[table_alias].strip().split()
-                # Use set to handle duplicates from the parent/join attribute
-                attributes = " ".join(sorted(list(set(attributes_list))))
-                # Check if there are attributes to project for this branch
-                if attributes:
-                    new_node = Node("PROJECTION " + attributes)
-                    # Insert the new projection node
-                    new_node.insert_node(tree_node, child_node)
+        # Start from the attributes required above (`dict`) and add the join attributes themselves
+        proj_dict = {k: v for k, v in dict.items()}
+        for att in join_attributes(tree_node.data):
+            alias = att.split('.')[0]
+            if att not in proj_dict.setdefault(alias, "").split():
+                proj_dict[alias] = (proj_dict[alias] + " " + att).strip()
+        for child_node in list(tree_node.children):
+            # --- Find the aliases of every table under the current child's subtree ---
+            leaves = []
+            find_leaves(child_node, leaves)
+            child_aliases = [find_alias(leaf.data) for leaf in leaves]
+            # Only the attributes of this branch's tables are passed down to it
+            current_proj_dict = {k: v for k, v in proj_dict.items() if k in child_aliases and v}
+            # Remove extra spaces and split into unique attributes
+            attributes_list = " ".join(current_proj_dict.values()).split()
+            # Use set to handle duplicates from the parent/join attribute
+            attributes = " ".join(sorted(list(set(attributes_list))))
+            # Check if there are attributes to project for this branch
+            if attributes:
+                new_node = Node("PROJECTION " + attributes)
+                # Insert the new projection node
+                new_node.insert_node(tree_node, child_node)
             # Continue recursion down the tree for complex children (JOIN/PROJECTION)
-            if "JOIN" in str(child_node.data) or "PROJECTION" in str(child_node.data):
+            if "JOIN" in str(child_node.data) or "PROJECTION" in str(child_node.data) or is_subquery_join(child_node):
                 # Pass down the projection dictionary determined for this branch
                 add_projections(child_node, current_proj_dict) 
     # Base case for non-JOIN, non-PROJECTION inner nodes (like SELECT, GROUP BY, ORDER BY)
     else:
         if tree_node.children != []:
-            # Pass down the projection dict for the child
+            # Pass down the projection dict for the child, with the attributes this node uses
+            dict = {k: v for k, v in dict.items()}
+            for att in find_attributes(tree_node.data):
+                alias = att.split('.')[0]
+                if att not in dict.setdefault(alias, "").split():
+                    dict[alias] = (dict[alias] + " " + att).strip()
             add_projections(tree_node.children[0], dict)
         
     return
 
-def main():
-    with open("input1.txt", "r") as file:
-        input = file.read()
-        schema, query = input.split("-- SQL Query --")
-    
-    expression = sqlglot.parse_one(query)
-    starting_arr = [expression.find(exp.Order), find_projection(expression), expression.find(exp.Having), expression.find(exp.Group), expression.find(exp.Where)]
-    join_arr = find_joins(expression)
-    tables = find_tables(expression)
+# Returns the alias of a table node, e.g. "Employee AS E" gives "E"
+def find_alias(node_data):
+    node_data = str(node_data).strip()
+    if ' AS ' in node_data:
+        return node_data.split(' AS ')[1].strip()
+    return node_data
 
-    tree = build_canonical(starting_arr, tables)
-    if "JOIN" in join_arr[0]:
-        insert_joins(tree[0], join_arr)
 
-    # Print the canonical query tree
-    print("---------------CANONICAL QUERY TREE---------------")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
+# Returns every qualified attribute (alias.attribute) used in a node
+def find_attributes(node_data):
+    return re.findall(r"\b[A-Za-z_]\w*\.\w+", str(node_data))
+
+
+# Returns every qualified attribute (alias.attribute) used in a join or subquery filter condition
+def join_attributes(node_data):
+    return find_attributes(re.sub(r"^FILTER|^.*?\bJOIN\b", "", str(node_data).strip(), count=1))
+
+
+# Checks if a node joins the query with the subtree of an unnested subquery, or filters it with
+# a subquery that could not be unnested
+def is_subquery_join(tree_node):
+    return str(tree_node.data).startswith(("SEMI JOIN", "ANTI JOIN", "AGGREGATE JOIN", "FILTER"))
+
+
+# Takes a condition and splits it into its conjunctive conditions.
+# Walks the ANDs with a stack since a long WHERE clause nests them deeper than the recursion limit
+def split_conjuncts(condition):
+    conjuncts = []
+    stack = [condition]
+    while stack:
+        condition = stack.pop().unnest()
+        if isinstance(condition, exp.And):
+            stack.append(condition.expression)
+            stack.append(condition.this)
+        else:
+            conjuncts.append(condition)
+    return conjuncts
+
+
+# Returns the Select expression wrapped by a subquery, or None if it is not a single query block
+def subquery_select(expression):
+    while isinstance(expression, exp.Subquery):
+        expression = expression.this
+    if isinstance(expression, exp.Select):
+        return expression
+    return None
+
+
+# Returns the tables and derived tables in the FROM clause of a query block
+def block_sources(block):
+    sources = block.find_all(exp.Table, exp.Subquery)
+    return [source for source in sources if in_block(source, block) and isinstance(source.parent, (exp.From, exp.Join))]
+
+
+# Renames a table alias of a query block and the columns that refer to it. Columns inside
+# nested blocks that define the same alias again refer to their own table and are left alone
+def rename_alias(block, old_alias, new_alias):
+    for source in block_sources(block):
+        if source.alias_or_name == old_alias:
+            source.set("alias", exp.TableAlias(this=exp.to_identifier(new_alias)))
+    for column in list(block.find_all(exp.Column)):
+        if column.table != old_alias:
+            continue
+        scope = column.find_ancestor(exp.Select)
+        while scope is not block and old_alias not in [s.alias_or_name for s in block_sources(scope)]:
+            scope = scope.find_ancestor(exp.Select)
+        if scope is block:
+            column.set("table", exp.to_identifier(new_alias))
+    return
+
+
+# Takes a subquery and moves its correlated conditions out of its WHERE clause.
+# An inner alias that is also used by the outer query is renamed first, so the join conditions
+# can tell the two tables apart. Returns the copied subquery, the correlated conditions, and the
+# aliases of the subquery's tables
+def decorrelate(sub_select, outer_aliases):
+    sub_select = sub_select.copy()
+    # The tables and derived tables in the subquery's FROM clause
+    inner_aliases = {source.alias_or_name for source in block_sources(sub_select)}
+    for alias in sorted(inner_aliases & set(outer_aliases)):
+        # Aliases are single letters elsewhere in the tree, so a free letter is preferred
+        used = inner_aliases | set(outer_aliases)
+        free = [c for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ" if c not in used]
+        new_alias = free[0] if free else alias + str(len(used))
+        rename_alias(sub_select, alias, new_alias)
+        inner_aliases = (inner_aliases - {alias}) | {new_alias}
+    local = []
+    correlated = []
+
+    where = sub_select.args.get("where")
+    if where is not None:
+        for condition in split_conjuncts(where.this):
+            columns = [c for c in condition.find_all(exp.Column) if in_block(c, sub_select)]
+            if any(c.table and c.table not in inner_aliases for c in columns):
+                correlated.append(condition)
+            else:
+                local.append(condition)
+        sub_select.set("where", None)
+        if local:
+            sub_select.where(exp.and_(*local), copy=False)
+
+    return sub_select, correlated, inner_aliases
+
+
+# Returns the inner columns of the correlated conditions, the subquery has to project them for the join
+def inner_columns(conditions, inner_aliases):
+    columns = []
+    for condition in conditions:
+        for column in condition.find_all(exp.Column):
+            if column.table in inner_aliases and column.sql() not in [c.sql() for c in columns]:
+                columns.append(column.copy())
+    return columns
+
+
+# Checks if a block nested inside the subquery uses a table of a query outside of the subquery, e.g.
+# P.Dnum = E.Dno in E.Ssn IN (SELECT W.Essn ... WHERE W.Pno IN (SELECT P.Pnumber ... WHERE P.Dnum = E.Dno)).
+# Only the subquery's own conditions become join conditions, so such a subquery is not unnested
+def nested_outer_reference(sub_select):
+    for column in sub_select.find_all(exp.Column):
+        if not column.table or in_block(column, sub_select):
+            continue
+        scope = column.find_ancestor(exp.Select)
+        while column.table not in [source.alias_or_name for source in block_sources(scope)]:
+            if scope is sub_select:
+                return True
+            scope = scope.find_ancestor(exp.Select)
+    return False
+
+
+# Turns one WHERE condition holding a subquery into a semi, anti or aggregate join.
+# Returns (join label, join conditions, subquery select, inner aliases) or None if the condition is left as is
+def unnest_condition(condition, outer_aliases):
+    negated = isinstance(condition, exp.Not)
+    inner = condition.this if negated else condition
+
+    # EXISTS / NOT EXISTS
+    if isinstance(inner, exp.Exists):
+        sub_select = subquery_select(inner.this)
+        if sub_select is None or nested_outer_reference(sub_select):
+            return None
+        sub_select, correlated, inner_aliases = decorrelate(sub_select, outer_aliases)
+        columns = inner_columns(correlated, inner_aliases)
+        if columns:
+            sub_select.set("expressions", columns)
+        return ("ANTI JOIN" if negated else "SEMI JOIN", correlated, sub_select, inner_aliases)
+
+    # IN / NOT IN
+    # NOT IN is treated as an anti join, which assumes the subquery attribute is never NULL
+    if isinstance(inner, exp.In) and inner.args.get("query") is not None:
+        sub_select = subquery_select(inner.args["query"])
+        if sub_select is None or len(sub_select.expressions) != 1 or nested_outer_reference(sub_select):
+            return None
+        sub_select, correlated, inner_aliases = decorrelate(sub_select, outer_aliases)
+        conditions = [exp.EQ(this=inner.this.copy(), expression=sub_select.expressions[0].copy())] + correlated
+        columns = [sub_select.expressions[0].copy()]
+        for column in inner_columns(correlated, inner_aliases):
+            if column.sql() not in [c.sql() for c in columns]:
+                columns.append(column)
+        sub_select.set("expressions", columns)
+        return ("ANTI JOIN" if negated else "SEMI JOIN", conditions, sub_select, inner_aliases)
+
+    # Scalar subqueries compared against an aggregate, e.g. E.Salary > (SELECT AVG(S.Salary) ...)
+    if negated or not isinstance(inner, (exp.EQ, exp.NEQ, exp.GT, exp.GTE, exp.LT, exp.LTE)):
+        return None
+    if isinstance(inner.expression, exp.Subquery):
+        outer_side, sub_side = inner.this, inner.expression
+    elif isinstance(inner.this, exp.Subquery):
+        outer_side, sub_side = inner.expression, inner.this
+    else:
+        return None
+    sub_select = subquery_select(sub_side)
+    if sub_select is None or len(sub_select.expressions) != 1 or sub_select.args.get("group") is not None or nested_outer_reference(sub_select):
+        return None
+    aggregate = sub_select.expressions[0].unalias()
+    # COUNT is left nested, an empty group would drop the row instead of comparing against 0
+    if not isinstance(aggregate, exp.AggFunc) or isinstance(aggregate, exp.Count):
+        return None
+    sub_select, correlated, inner_aliases = decorrelate(sub_select, outer_aliases)
+    # The aggregate is taken again since decorrelate may have renamed its alias
+    aggregate = sub_select.expressions[0].unalias()
+    # Only equality correlations can become the keys of a grouped join
+    if any(not isinstance(c, exp.EQ) for c in correlated):
+        return None
+    keys = inner_columns(correlated, inner_aliases)
+    sub_select.set("expressions", keys + [aggregate.copy()])
+    if keys:
+        sub_select.group_by(*[k.copy() for k in keys], copy=False)
+    comparison = inner.__class__(this=outer_side.copy(), expression=aggregate.copy())
+    if isinstance(inner.this, exp.Subquery):
+        comparison = inner.__class__(this=aggregate.copy(), expression=outer_side.copy())
+    return ("AGGREGATE JOIN", correlated + [comparison], sub_select, inner_aliases)
+
+
+# Removes the IN, EXISTS, NOT EXISTS and scalar subqueries from the WHERE clause of a query block.
+# Returns the rewritten block and the subquery joins that replace them.
+# Only top level conjunctive conditions are unnested. Any other condition holding a subquery, e.g. one
+# under an OR or a COUNT subquery, becomes a FILTER that is kept whole, since the selection steps
+# split their conditions on SELECT and AND
+def unnest_subqueries(block):
+    block = block.copy()
+    subquery_joins = []
+    where = block.args.get("where")
+    if where is None:
+        return block, subquery_joins
+
+    outer_aliases = [source.alias_or_name for source in block_sources(block)]
+    remaining = []
+    for condition in split_conjuncts(where.this):
+        if condition.find(exp.Select) is None:
+            remaining.append(condition)
+            continue
+        result = unnest_condition(condition, outer_aliases)
+        if result is None:
+            inner_aliases = {c.table for c in condition.find_all(exp.Column) if c.table not in outer_aliases}
+            subquery_joins.append(("FILTER", [condition], None, inner_aliases))
+        else:
+            subquery_joins.append(result)
+
+    block.set("where", None)
+    if remaining:
+        block.where(exp.and_(*remaining), copy=False)
+
+    return block, subquery_joins
+
+
+# Finds where a subquery join goes in the tree: above the lowest node that has every outer table the
+# join uses, and above the selections on that node, so the selections can still become joins below it.
+# A join that uses no outer table goes above the whole join tree
+def find_subquery_join_target(root, outer_aliases):
+    target = root
+    while target.children and str(target.data).startswith(("PROJECTION", "ORDER", "HAVING", "GROUP")):
+        target = target.children[0]
+
+    # The path from the root down to each outer table the join uses
+    leaf_nodes = []
+    if outer_aliases:
+        find_outer_leaves(target, leaf_nodes)
+    paths = []
+    for leaf in leaf_nodes:
+        if find_alias(leaf.data) in outer_aliases:
+            path = []
+            tree_node = leaf
+            while tree_node is not None:
+                path.insert(0, tree_node)
+                tree_node = tree_node.parent
+            paths.append(path)
+
+    if outer_aliases and len(paths) == len(outer_aliases):
+        for nodes in zip(*paths):
+            if any(tree_node is not nodes[0] for tree_node in nodes):
+                break
+            target = nodes[0]
+        while target.parent is not None and str(target.parent.data).startswith("SELECT"):
+            target = target.parent
+
+    return target
+
+
+# Finds the leaves of the outer query below a node, the subquery side of a subquery join is skipped
+def find_outer_leaves(tree_node, leaf_nodes):
+    spend_budget()
+    if not tree_node.children:
+        leaf_nodes.append(tree_node)
+    for child_node in tree_node.children[:1] if is_subquery_join(tree_node) else tree_node.children:
+        find_outer_leaves(child_node, leaf_nodes)
+    return
+
+
+# Takes the schema definitions and returns the catalog, the attributes and keys of every relation.
+# Names are lowercase since they are case-insensitive
+def parse_schema(schema):
+    catalog = {}
+    schema = "\n".join(line for line in schema.splitlines() if not line.strip().startswith("--"))
+    schema = re.sub(r"MATERIALIZED\s+VIEW.*?(?:;|$)", "", schema, flags=re.IGNORECASE | re.DOTALL)
+
+    for name, body in re.findall(r"(\w+)\s*\(((?:[^()]|\([^()]*\))*)\)", schema):
+        key_pattern = r"(?:PRIMARY\s+KEY|UNIQUE)\s*\(([^)]*)\)"
+        keys = [[a.strip().lower() for a in key.split(",")] for key in re.findall(key_pattern, body, re.IGNORECASE)]
+        body = re.sub(key_pattern, "", body, flags=re.IGNORECASE)
+        # Optional statistics, e.g. ROWS(5000)
+        rows = re.findall(r"ROWS\s*\((\d+)\)", body, re.IGNORECASE)
+        body = re.sub(r"ROWS\s*\(\d+\)", "", body, flags=re.IGNORECASE)
+        attributes = [a.strip().lower() for a in body.split(",") if a.strip()]
+        catalog[name.lower()] = {"attributes": attributes, "keys": keys}
+        if rows:
+            catalog[name.lower()]["rows"] = int(rows[0])
+
+    return catalog
+
+
+# Opens the feedback file, creating the table on first use
+def open_feedback(path):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE IF NOT EXISTS feedback (signature TEXT PRIMARY KEY, selectivity REAL, weight REAL, estimated_rows REAL, actual_rows REAL, updated REAL)")
+    return connection
+
+
+# Returns the signature a predicate is stored under in the feedback file, e.g.
+# "E.Bdate > '1957-12-31'" with E -> Employee gives "employee.bdate > '1957-12-31'"
+def predicate_signature(condition, alias_map):
+    return normalize_condition(str(condition), alias_map)
+
+
+# Reports the cardinalities of an executed selection back to the feedback file.
+# Older observations are decayed by their age so the selectivity follows the current data
+def record_feedback(signature, estimated_rows, actual_rows, input_rows, path=FEEDBACK_FILE, now=None):
+    if input_rows <= 0:
+        return
+    now = time.time() if now is None else now
+    observed = min(actual_rows / input_rows, 1.0)
+
+    connection = open_feedback(path)
+    row = connection.execute("SELECT selectivity, weight, updated FROM feedback WHERE signature = ?", (signature,)).fetchone()
+    if row is None:
+        selectivity, weight = observed, 1.0
+    else:
+        old_weight = row[1] * 0.5 ** ((now - row[2]) / FEEDBACK_HALF_LIFE)
+        weight = old_weight + 1.0
+        selectivity = (row[0] * old_weight + observed) / weight
+    connection.execute("INSERT OR REPLACE INTO feedback VALUES (?, ?, ?, ?, ?, ?)", (signature, selectivity, weight, estimated_rows, actual_rows, now))
+    connection.commit()
+    connection.close()
+    return
+
+
+# Loads the learned selectivities from the feedback file. Observations whose decayed weight has
+# dropped below MIN_FEEDBACK_WEIGHT are stale and left out so the static guesses are used again
+def load_feedback(path=FEEDBACK_FILE, now=None):
+    feedback = {}
+    if not os.path.exists(path):
+        return feedback
+    now = time.time() if now is None else now
+
+    connection = open_feedback(path)
+    for signature, selectivity, weight, updated in connection.execute("SELECT signature, selectivity, weight, updated FROM feedback"):
+        if weight * 0.5 ** ((now - updated) / FEEDBACK_HALF_LIFE) >= MIN_FEEDBACK_WEIGHT:
+            feedback[signature] = selectivity
+    connection.close()
+
+    return feedback
+
+
+# Guesses the selectivity of a condition from its predicate type and the keys in the catalog
+def static_selectivity(condition, alias_map, catalog):
+    spend_budget()
+    condition = condition.unnest()
+    if isinstance(condition, exp.And):
+        return static_selectivity(condition.this, alias_map, catalog) * static_selectivity(condition.expression, alias_map, catalog)
+    if isinstance(condition, exp.Or):
+        left = static_selectivity(condition.this, alias_map, catalog)
+        right = static_selectivity(condition.expression, alias_map, catalog)
+        return left + right - left * right
+    if isinstance(condition, exp.Not):
+        return 1 - static_selectivity(condition.this, alias_map, catalog)
+
+    if isinstance(condition, exp.EQ):
+        column = condition.this if isinstance(condition.this, exp.Column) else condition.expression
+        if isinstance(column, exp.Column):
+            keys = catalog.get(alias_map.get(column.table, column.table).lower(), {}).get("keys", [])
+            if [column.name.lower()] in keys:
+                return KEY_EQUALITY_SELECTIVITY
+            if any(column.name.lower() in key for key in keys):
+                return PARTIAL_KEY_EQUALITY_SELECTIVITY
+        return EQUALITY_SELECTIVITY
+    if isinstance(condition, exp.NEQ):
+        return NOT_EQUAL_SELECTIVITY
+    if isinstance(condition, (exp.GT, exp.GTE, exp.LT, exp.LTE)):
+        return RANGE_SELECTIVITY
+
+    return DEFAULT_SELECTIVITY
+
+
+# Returns the selectivity of a selection node. Learned feedback is used first, then the table's
+# sample and the static guess last
+def estimate_selectivity(node_data, alias_map, catalog, feedback):
+    condition = str(node_data).strip()
+    if condition.startswith("SELECT"):
+        condition = condition[len("SELECT"):].strip()
+    signature = predicate_signature(condition, alias_map)
+    if signature in feedback:
+        return feedback[signature]
+    # Conditions the string handling has cut apart, e.g. around a subquery under an OR, get the default
+    try:
+        parsed = sqlglot.parse_one(condition)
+    except sqlglot.errors.ParseError:
+        return DEFAULT_SELECTIVITY
+    # Then the sample of the table's data file, if there is one
+    sampled = sample_selectivity(parsed, alias_map, catalog)
+    if sampled is not None:
+        return sampled
+    return static_selectivity(parsed, alias_map, catalog)
+
+
+# Returns the aliases of the tables used by a condition
+def condition_aliases(node_data):
+    return {att.split('.')[0] for att in find_attributes(node_data)}
+
+
+# Takes the top of a branch and returns the selections directly above its table, top to bottom, and the table
+def selection_chain(tree_node):
+    chain = []
+    while tree_node.children:
+        if str(tree_node.data).startswith("SELECT"):
+            chain.append(tree_node)
+        tree_node = tree_node.children[0]
+    return chain, tree_node
+
+
+# Splits the join part of the tree into branches (a table with everything applied only to it)
+# and the join conditions between them. Returns False if the part can not be reordered
+def collect_branches(tree_node, branches, join_conditions):
+    spend_budget()
+    data = str(tree_node.data).strip()
+    if data == "X":
+        for child_node in tree_node.children:
+            if not collect_branches(child_node, branches, join_conditions):
+                return False
+    elif data.startswith("SELECT") and len(condition_aliases(data)) > 1 and tree_node.children:
+        join_conditions.append(data)
+        return collect_branches(tree_node.children[0], branches, join_conditions)
+    elif "JOIN" in data and not is_subquery_join(tree_node):
+        # Outer joins written in the query keep their order
+        return False
+    elif is_subquery_join(tree_node):
+        # A subquery join over several tables keeps them together
+        leaf_nodes = []
+        find_outer_leaves(tree_node, leaf_nodes)
+        if len(leaf_nodes) > 1:
+            return False
+        branches.append(tree_node)
+    else:
+        branches.append(tree_node)
+    return True
+
+
+# Reorders the tables and their selections so the most restrictive selections are applied first.
+# Within a table the most selective selection goes closest to the table, and the tables are put into
+# the cartesian chain from most to least selective, preferring tables that join the ones already placed
+def order_by_selectivity(root, catalog, feedback):
+    alias_map = find_alias_map(root)
+
+    # Order the selections above each table
+    leaf_nodes = []
+    find_leaves(root, leaf_nodes)
+    for leaf in leaf_nodes:
+        chain = []
+        tree_node = leaf.parent
+        while tree_node is not None and str(tree_node.data).startswith("SELECT") and len(condition_aliases(tree_node.data)) == 1:
+            chain.append(tree_node)
+            tree_node = tree_node.parent
+        datas = sorted((node.data for node in chain), key=lambda d: estimate_selectivity(d, alias_map, catalog, feedback))
+        for node, data in zip(chain, datas):
+            node.data = data
+
+    # Find the top of the join part of the tree
+    top = root
+    while top.children and (str(top.data).startswith(("PROJECTION", "ORDER", "HAVING", "GROUP")) or is_subquery_join(top)):
+        top = top.children[0]
+    branches = []
+    join_conditions = []
+    if top.parent is None or not collect_branches(top, branches, join_conditions) or len(branches) < 2:
+        return
+
+    # Estimate each branch by the selections above its table
+    estimates = {}
+    branch_alias = {}
+    for branch in branches:
+        chain, leaf = selection_chain(branch)
+        branch_alias[id(branch)] = find_alias(leaf.data)
+        estimates[id(branch)] = 1.0
+        for node in chain:
+            estimates[id(branch)] *= estimate_selectivity(node.data, alias_map, catalog, feedback)
+
+    # Pick the most selective branch first, then the most selective branch joined to the ones placed
+    order = []
+    placed = set()
+    remaining = sorted(branches, key=lambda b: estimates[id(b)])
+    while remaining:
+        connected = [b for b in remaining if any(branch_alias[id(b)] in aliases and aliases & placed for aliases in map(condition_aliases, join_conditions))]
+        branch = connected[0] if connected else remaining[0]
+        remaining.remove(branch)
+        order.append(branch)
+        placed.add(branch_alias[id(branch)])
+
+    # Rebuild the cartesian chain with the first branches deepest in the tree
+    parent = top.parent
+    for branch in branches:
+        branch.parent.remove_child(branch)
+    new_top = order[0]
+    cartesians = []
+    for branch in order[1:]:
+        cart_node = Node("X")
+        cart_node.add_child(branch)
+        cart_node.add_child(new_top)
+        covered = {branch_alias[id(b)] for b in order[:len(cartesians) + 2]}
+        cartesians.append((cart_node, covered))
+        new_top = cart_node
+
+    # Put each join condition right above the lowest cartesian that has all of its tables
+    for data in join_conditions:
+        cart_node = cartesians[-1][0]
+        for node, covered in cartesians:
+            if condition_aliases(data) <= covered:
+                cart_node = node
+                break
+        sel_node = Node(data)
+        if cart_node.parent is None:
+            sel_node.add_child(cart_node)
+        else:
+            sel_node.insert_node(cart_node.parent, cart_node)
+        while new_top.parent is not None:
+            new_top = new_top.parent
+
+    replace_node(top, new_top)
+    return
+
+
+# Returns the CSV rows of a file starting at a byte offset, the header is skipped at offset 0.
+# Returns (header, rows, end offset, whether the file ends with a newline)
+def read_csv_rows(path, offset):
+    header = None
+    rows = []
+    ends_with_newline = True
+    with open(path, "rb") as file:
+        header_line = file.readline()
+        header = [h.strip().lower() for h in next(csv.reader([header_line.decode()]))]
+        if offset == 0:
+            offset = len(header_line)
+        file.seek(offset)
+        for line in file:
+            offset += len(line)
+            ends_with_newline = line.endswith(b"\n")
+            if line.strip():
+                rows.append(next(csv.reader([line.decode()])))
+    return header, rows, offset, ends_with_newline
+
+
+# Returns the hash used for correlated sampling, a number in [0, 1) that is the same for equal join keys
+def key_hash(key):
+    return zlib.crc32(str(key).strip().encode()) / 2 ** 32
+
+
+# Returns the CRC32 checksum of the first size bytes of a file, to tell whether a cached part of
+# the file was edited in place
+def file_checksum(path, size):
+    checksum = 0
+    with open(path, "rb") as file:
+        while size > 0:
+            chunk = file.read(min(size, 1 << 20))
+            if not chunk:
+                break
+            checksum = zlib.crc32(chunk, checksum)
+            size -= len(chunk)
+    return checksum
+
+
+# Returns whether a cached CSV sample can continue with the rows appended since: the file has
+# only grown and the bytes it was sampled from are unchanged
+def can_continue_sample(path, meta, status):
+    return meta["ends_with_newline"] and status.st_size > meta["size"] and file_checksum(path, meta["size"]) == meta.get("checksum")
+
+
+# Loads a cached sample, or returns None if it is missing
+def load_sample_file(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data["__meta__"]))
+        columns = {name: data[name] for name in data.files if name != "__meta__"}
+    return meta, columns
+
+
+# Saves a sample compactly as a compressed NumPy file. It is written to a temporary file first and
+# moved into place, so a reader never sees half of a sample
+def save_sample_file(path, meta, columns):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(temporary_path, "wb") as file:
+            np.savez_compressed(file, __meta__=np.array(json.dumps(meta)), **columns)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+    return
+
+
+# Returns the reservoir sample of a CSV file as {column: array} and the number of rows in the file.
+# The sample is cached next to the data and when the file has only grown since, just the new
+# rows are read and the reservoir sampling continues from where it stopped. The file is sampled
+# again from the start if the part that was read before has changed
+def csv_reservoir_sample(path, cache_path):
+    status = os.stat(path)
+    cached = load_sample_file(cache_path)
+    if cached is not None and cached[0]["mtime"] == status.st_mtime and cached[0]["size"] == status.st_size:
+        return cached[1], cached[0]["rows"]
+
+    offset = 0
+    seen = 0
+    reservoir = []
+    if cached is not None and can_continue_sample(path, cached[0], status):
+        meta, columns = cached
+        offset, seen = meta["size"], meta["rows"]
+        reservoir = [list(row) for row in zip(*[columns[h] for h in meta["header"]])]
+
+    header, rows, offset, ends_with_newline = read_csv_rows(path, offset)
+    generator = random.Random(path + ":" + str(seen))
+    for row in rows:
+        seen += 1
+        if len(reservoir) < SAMPLE_SIZE:
+            reservoir.append(row)
+        else:
+            index = generator.randrange(seen)
+            if index < SAMPLE_SIZE:
+                reservoir[index] = row
+
+    columns = {h: np.array([row[i] if i < len(row) else "" for row in reservoir], dtype=str) for i, h in enumerate(header)}
+    meta = {"mtime": status.st_mtime, "size": offset, "rows": seen, "header": header, "ends_with_newline": ends_with_newline,
+            "checksum": file_checksum(path, offset)}
+    save_sample_file(cache_path, meta, columns)
+    return columns, seen
+
+
+# Returns a block sample of a Parquet file, whole row groups picked at random until there are
+# SAMPLE_SIZE rows, and the number of rows in the file. It is cached until the file changes
+def parquet_block_sample(path, cache_path):
+    if pq is None:
+        raise ImportError("sampling Parquet files needs pyarrow, run pip install pyarrow")
+    status = os.stat(path)
+    cached = load_sample_file(cache_path)
+    if cached is not None and cached[0]["mtime"] == status.st_mtime:
+        return cached[1], cached[0]["rows"]
+
+    parquet = pq.ParquetFile(path)
+    groups = list(range(parquet.num_row_groups))
+    random.Random(path).shuffle(groups)
+    tables = []
+    sampled = 0
+    for group in groups:
+        if sampled >= SAMPLE_SIZE:
+            break
+        tables.append(parquet.read_row_group(group))
+        sampled += tables[-1].num_rows
+
+    columns = {}
+    for name in parquet.schema_arrow.names:
+        values = [v for table in tables for v in table.column(name).to_pylist()]
+        columns[name.lower()] = np.array(["" if v is None else str(v) for v in values], dtype=str)
+    meta = {"mtime": status.st_mtime, "rows": parquet.metadata.num_rows}
+    save_sample_file(cache_path, meta, columns)
+    return columns, meta["rows"]
+
+
+# Returns the correlated sample of a join attribute: the values whose key_hash is below the
+# sampling rate, so two tables keep the same join keys. Returns (rate, values, hashes).
+# Appended CSV rows are filtered and added to the cached sample
+def correlated_sample(entry, attribute):
+    path = entry["data_file"]
+    cache_path = os.path.join(os.path.dirname(path), SAMPLE_DIRECTORY, os.path.basename(path) + "." + attribute + ".npz")
+    status = os.stat(path)
+    cached = load_sample_file(cache_path)
+    if cached is not None and cached[0]["mtime"] == status.st_mtime:
+        return cached[0]["rate"], cached[1]["values"], cached[1]["hashes"]
+
+    rate = min(1.0, CORRELATED_SAMPLE_SIZE / max(entry["rows"], 1))
+    values = []
+    offset = 0
+    if path.endswith(".parquet"):
+        ends_with_newline = False
+        column = pq.read_table(path, columns=[c for c in pq.ParquetFile(path).schema_arrow.names if c.lower() == attribute])
+        new_values = [str(v) for v in column.column(0).to_pylist() if v is not None]
+    else:
+        if cached is not None and can_continue_sample(path, cached[0], status):
+            rate, offset = cached[0]["rate"], cached[0]["size"]
+            values = list(cached[1]["values"])
+        header, rows, offset, ends_with_newline = read_csv_rows(path, offset)
+        if attribute not in header:
+            return None
+        index = header.index(attribute)
+        new_values = [row[index].strip() for row in rows if index < len(row)]
+
+    values += [v for v in new_values if key_hash(v) < rate]
+    columns = {"values": np.array(values, dtype=str), "hashes": np.array([key_hash(v) for v in values], dtype=float)}
+    meta = {"mtime": status.st_mtime, "size": offset, "rate": rate, "ends_with_newline": ends_with_newline,
+            "checksum": 0 if path.endswith(".parquet") else file_checksum(path, offset)}
+    save_sample_file(cache_path, meta, columns)
+    return rate, columns["values"], columns["hashes"]
+
+
+# Finds the CSV or Parquet file of every relation in the data directory and adds its sample and
+# row count to the catalog. Relations with a data file but no schema entry are added too
+def load_samples(catalog, data_directory):
+    if np is None:
+        raise ImportError("sampling data files needs numpy, run pip install numpy")
+    for file_name in sorted(os.listdir(data_directory)):
+        table, extension = os.path.splitext(file_name)
+        if extension.lower() not in (".csv", ".parquet"):
+            continue
+        path = os.path.join(data_directory, file_name)
+        cache_path = os.path.join(data_directory, SAMPLE_DIRECTORY, file_name + ".npz")
+        if extension.lower() == ".csv":
+            sample, rows = csv_reservoir_sample(path, cache_path)
+        else:
+            sample, rows = parquet_block_sample(path, cache_path)
+        entry = catalog.setdefault(table.lower(), {"attributes": list(sample), "keys": []})
+        entry["sample"] = sample
+        entry["rows"] = rows
+        entry["data_file"] = path
+    return
+
+
+# Converts a sample column to numbers, NaN where a cell is empty or not a number. Plain decimals
+# are converted by NumPy at once, only the other cells (exponents, stray text) are tried one by one
+def sample_numbers(values):
+    numbers = np.full(len(values), np.nan)
+    stripped = np.char.strip(values)
+    signed = np.char.startswith(stripped, "-") | np.char.startswith(stripped, "+")
+    unsigned = np.char.lstrip(stripped, "+-")
+    plain = np.char.isdigit(np.char.replace(unsigned, ".", "", 1)) & (np.char.str_len(unsigned) == np.char.str_len(stripped) - signed)
+    try:
+        numbers[plain] = stripped[plain].astype(float)
+    except ValueError:
+        # Digits NumPy can not read, such as superscripts
+        plain[:] = False
+    for i in np.flatnonzero(~plain & (stripped != "")):
+        try:
+            numbers[i] = float(stripped[i])
+        except ValueError:
+            pass
+    return numbers, np.isnan(numbers)
+
+
+# Returns the values of an expression over the rows of a sample and which of them are NULL,
+# or None if it can not be evaluated. Empty cells, and cells that are not numbers when comparing
+# as numbers, are NULL
+def sample_values(expression, sample, as_number):
+    if isinstance(expression, exp.Column):
+        values = sample.get(expression.name.lower())
+        if values is None:
+            return None
+        if not as_number:
+            return values, values == ""
+        return sample_numbers(values)
+    if isinstance(expression, exp.Literal):
+        if as_number and not expression.is_string:
+            return float(expression.this), False
+        return expression.this, False
+    if isinstance(expression, exp.Neg) and isinstance(expression.this, exp.Literal) and as_number:
+        return -float(expression.this.this), False
+    return None
+
+
+# Evaluates a single table condition on a sample and returns masks of the matching rows and of the
+# rows where it is unknown because of a NULL, or None if the condition uses something the sample
+# can not evaluate. Unknown rows never match, also under a NOT
+def sample_mask(condition, sample):
+    condition = condition.unnest()
+    if isinstance(condition, (exp.And, exp.Or)):
+        left = sample_mask(condition.this, sample)
+        right = sample_mask(condition.expression, sample)
+        if left is None or right is None:
+            return None
+        (left_match, left_unknown), (right_match, right_unknown) = left, right
+        if isinstance(condition, exp.And):
+            matches = left_match & right_match
+            known_false = (~left_match & ~left_unknown) | (~right_match & ~right_unknown)
+            return matches, (left_unknown | right_unknown) & ~known_false
+        matches = left_match | right_match
+        return matches, (left_unknown | right_unknown) & ~matches
+    if isinstance(condition, exp.Not):
+        mask = sample_mask(condition.this, sample)
+        return None if mask is None else (~mask[0] & ~mask[1], mask[1])
+
+    operators = {exp.EQ: np.equal, exp.NEQ: np.not_equal, exp.GT: np.greater, exp.GTE: np.greater_equal, exp.LT: np.less, exp.LTE: np.less_equal}
+    if type(condition) not in operators:
+        return None
+    # Compare as numbers when either side is a number literal, otherwise as strings
+    as_number = any(isinstance(side, exp.Literal) and not side.is_string or isinstance(side, exp.Neg) for side in (condition.this, condition.expression))
+    left = sample_values(condition.this, sample, as_number)
+    right = sample_values(condition.expression, sample, as_number)
+    if left is None or right is None:
+        return None
+    unknown = np.logical_or(left[1], right[1])
+    with np.errstate(invalid="ignore"):
+        matches = operators[type(condition)](left[0], right[0])
+    return np.broadcast_to(matches & ~unknown, unknown.shape), unknown
+
+
+# Estimates the selectivity of a single table condition from the table's sample, or returns None
+def sample_selectivity(condition, alias_map, catalog):
+    tables = {alias_map.get(c.table, c.table).lower() for c in condition.find_all(exp.Column)}
+    if len(tables) != 1:
+        return None
+    sample = catalog.get(tables.pop(), {}).get("sample")
+    if not sample or not len(next(iter(sample.values()))):
+        return None
+    mask = sample_mask(condition, sample)
+    if mask is None:
+        return None
+    # Half a row when nothing matches, a sample can not show that no rows match
+    return max(float(np.count_nonzero(mask[0])), 0.5) / len(mask[0])
+
+
+# Estimates the number of rows of an equality join from correlated samples of the two join
+# attributes, or returns None when either table has no data file
+def sample_join_size(left, right, alias_map, catalog):
+    samples = []
+    for column in (left, right):
+        entry = catalog.get(alias_map.get(column.table, column.table).lower(), {})
+        if "data_file" not in entry:
+            return None
+        sample = correlated_sample(entry, column.name.lower())
+        if sample is None:
+            return None
+        samples.append(sample)
+
+    # Both samples are cut down to the smaller rate so they keep the same keys
+    rate = min(samples[0][0], samples[1][0])
+    counts = []
+    for sample_rate, values, hashes in samples:
+        keys, key_counts = np.unique(values[hashes < rate], return_counts=True)
+        counts.append(dict(zip(keys, key_counts)))
+    matches = sum(int(count) * int(counts[1].get(key, 0)) for key, count in counts[0].items())
+    return matches / rate
+
+
+# Returns the number of rows and the width (number of attributes) of a table from the catalog
+def table_size(table, catalog):
+    entry = catalog.get(str(table).split(' AS ')[0].strip().lower(), {})
+    rows = entry.get("rows", DEFAULT_TABLE_ROWS)
+    width = len(entry.get("attributes", [])) or DEFAULT_TABLE_WIDTH
+    return rows, width
+
+
+# Returns the selectivity of a join condition. An equality returns one row for each row of the
+# bigger side when it uses a key, otherwise the attribute is assumed to have 1 / EQUALITY_SELECTIVITY values
+def join_selectivity(condition, alias_map, catalog):
+    try:
+        parsed = sqlglot.parse_one(condition)
+    except sqlglot.errors.ParseError:
+        return DEFAULT_SELECTIVITY
+    if not isinstance(parsed, exp.EQ) or not isinstance(parsed.this, exp.Column) or not isinstance(parsed.expression, exp.Column):
+        return RANGE_SELECTIVITY
+
+    # Use the data files when both tables have one
+    size = sample_join_size(parsed.this, parsed.expression, alias_map, catalog)
+    if size is not None:
+        left_rows, width = table_size(alias_map.get(parsed.this.table, parsed.this.table), catalog)
+        right_rows, width = table_size(alias_map.get(parsed.expression.table, parsed.expression.table), catalog)
+        return min(1.0, max(size, 1.0) / max(left_rows * right_rows, 1))
+
+    distinct = []
+    for column in (parsed.this, parsed.expression):
+        table = alias_map.get(column.table, column.table).lower()
+        rows, width = table_size(table, catalog)
+        if [column.name.lower()] in catalog.get(table, {}).get("keys", []):
+            distinct.append(rows)
+        else:
+            distinct.append(1 / EQUALITY_SELECTIVITY)
+    return 1 / max(distinct)
+
+
+# Returns the selectivity of a node holding one or more selection or join conditions
+def node_selectivity(node_data, alias_map, catalog, feedback):
+    condition = str(node_data).strip()
+    for label in ("SEMI JOIN", "ANTI JOIN", "AGGREGATE JOIN", "SELECT", "JOIN"):
+        if condition.startswith(label):
+            condition = condition[len(label):]
+            break
+    if " ON " in condition:
+        condition = condition.split(" ON ", 1)[1]
+
+    selectivity = 1.0
+    for part in re.split(r"\bSELECT\b|\bAND\b", condition):
+        if not part.strip():
+            continue
+        if len(condition_aliases(part)) > 1:
+            selectivity *= join_selectivity(part.strip(), alias_map, catalog)
+        else:
+            selectivity *= estimate_selectivity(part, alias_map, catalog, feedback)
+    return selectivity
+
+
+# rows x width over every intermediate result, including the table scans. Projections are not
+# results of their own, they narrow the width of the results above them
+def estimate_cost(tree_node, alias_map, catalog, feedback):
+    data = str(tree_node.data).strip()
+    if not tree_node.children:
+        # Floats so the sizes of long cartesian chains go to infinity instead of overflowing
+        rows, width = table_size(data, catalog)
+        return float(rows), width, float(rows * width)
+
+    children = [estimate_cost(child_node, alias_map, catalog, feedback) for child_node in tree_node.children]
+    rows, width = children[0][0], children[0][1]
+    cost = sum(child[2] for child in children)
+
+    if data == "X":
+        rows = children[0][0] * children[1][0]
+        width = children[0][1] + children[1][1]
+    elif is_subquery_join(tree_node):
+        # The subquery only filters the outer rows, an aggregate join adds the aggregate
+        if data.startswith("AGGREGATE JOIN"):
+            width += 1
+        rows = rows * DEFAULT_SELECTIVITY
+    elif "JOIN" in data:
+        rows = children[0][0] * children[1][0] * node_selectivity(data, alias_map, catalog, feedback)
+        width = children[0][1] + children[1][1]
+        # A left outer join keeps every row of the left side
+        if data.startswith("LEFT"):
+            rows = max(rows, children[0][0])
+    elif data.startswith("SELECT"):
+        rows = rows * node_selectivity(data, alias_map, catalog, feedback)
+    elif data.startswith("PROJECTION"):
+        # A projection is applied as its input is produced, it adds no result of its own
+        # and only narrows the rows the steps above it work on
+        return rows, min(width, len(data.split()) - 1), cost
+    elif data.startswith("GROUP"):
+        rows = max(1, rows * EQUALITY_SELECTIVITY)
+    elif data.startswith("HAVING"):
+        rows = rows * RANGE_SELECTIVITY
+
+    return rows, width, cost + rows * width
+
+
+# Returns the estimated cost of a whole query tree
+def plan_cost(root, catalog, feedback):
+    rows, width, cost = estimate_cost(root, find_alias_map(root), catalog, feedback)
+    return cost
+
+
+# Adds the cost of the tree after an optimization step to the costs dictionary, if costs are being kept.
+# Subquery joins that are not joined in yet are costed above the whole join tree, so every step
+# costs the same work. Costing is not part of the optimization so it does not spend from the budget
+def record_stage_cost(costs, stage, root, catalog, feedback, subquery_joins=()):
+    if costs is not None:
+        previous_budget = set_active_budget(None)
+        if subquery_joins:
+            root = copy_tree(root)
+            subquery_joins = [(label, conditions, None if subquery_tree is None else copy_tree(subquery_tree), inner_aliases) for label, conditions, subquery_tree, inner_aliases in subquery_joins]
+            attach_subquery_joins(root, subquery_joins, False)
+        try:
+            costs[stage] = plan_cost(root, catalog, feedback)
+        except RecursionError:
+            # A tree too deep to cost is never preferred
+            costs[stage] = float("inf")
+        set_active_budget(previous_budget)
+    return
+
+
+# Optimizes every query of a corpus and returns {file name: {stage: cost}}.
+# Feedback is left out so the costs only change when the optimizer changes
+def corpus_costs(files):
+    results = {}
+    for file_name in files:
+        with open(file_name, "r") as file:
+            schema, query = file.read().split("-- SQL Query --")
+        catalog = parse_schema(schema)
+        costs = {}
+        optimize_query(sqlglot.parse_one(query), False, catalog, {}, costs)
+        results[file_name] = costs
+    return results
+
+
+# Compares the final cost of every query to the recorded costs.
+# Returns the queries that got worse by more than COST_REGRESSION_THRESHOLD
+def find_cost_regressions(results, baseline):
+    regressions = []
+    for file_name, costs in results.items():
+        if file_name not in baseline:
+            continue
+        old_cost = baseline[file_name][COST_STAGES[-1]]
+        new_cost = costs[COST_STAGES[-1]]
+        if new_cost > old_cost * (1 + COST_REGRESSION_THRESHOLD):
+            regressions.append((file_name, old_cost, new_cost))
+    return regressions
+
+
+# Prints the cost of each query after every optimization step
+def print_costs(results):
+    print("query".ljust(24) + "".join(stage.rjust(14) for stage in COST_STAGES))
+    for file_name, costs in results.items():
+        print(file_name.ljust(24) + "".join(("%.0f" % costs[stage]).rjust(14) for stage in COST_STAGES))
+    print()
+    return
+
+
+# Prints out the tree of one optimization step
+def print_stage(title, tree_node, show):
+    if show:
+        print(title)
+        print_tree(tree_node, 0)
+        print("--------------------------------------------------\n")
+    return
+
+
+# Joins in the separately optimized subquery trees. They filter like selections so when push_down is set
+# they go above the tables they use, otherwise above the whole join tree.
+# All targets are found first so a subquery tree is never mistaken for part of the outer query
+def attach_subquery_joins(root, subquery_joins, push_down):
+    placements = []
+    for label, conditions, subquery_tree, inner_aliases in subquery_joins:
+        outer_aliases = set()
+        if push_down:
+            for condition in conditions:
+                for column in condition.find_all(exp.Column):
+                    if column.table and column.table not in inner_aliases:
+                        outer_aliases.add(column.table)
+        join_node = Node((label + " " + " AND ".join(c.sql() for c in conditions)).strip())
+        placements.append((find_subquery_join_target(root, outer_aliases), join_node, subquery_tree))
+    for target, join_node, subquery_tree in placements:
+        join_node.insert_node(target.parent, target)
+        if subquery_tree is not None:
+            join_node.add_child(subquery_tree)
+    return
 
-    # Perform the cascade of selections and print out the result
-    cascade_selection(tree[0])
-    print("--------HEURISTIC 1: CASCADE OF SELECTIONS--------")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
 
-    # Perform the moving down of selections as low as possible
+# Heuristic 2: moves the selections as low as possible and joins in the subquery trees
+def push_selections_down(tree, subquery_joins):
     selection_down(tree[0])
     for i in tree:
         if "SELECT" in str(i.data):
             parent = i.parent
             parent.remove_child(i)
             parent.add_child(i.children[0])
-            break            
-    print("--------HEURISTIC 2: PUSH SELECTIONS DOWN---------")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
-
-    # SELECTIVITY
-    print("-----HEURISTIC 3: Smallest Selectivity First------")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
-
-    # Merge selections and cartesians into joins
-    create_joins(tree[0])
-    print("----HEURISTIC 4: Replace Cartesian + Selection----")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
-
-    # Add projection throughout the query tree
-    if "PROJECTION" not in str(tree[0].data):
-        add_projections(tree[0].children[0], {})
+            break
+    attach_subquery_joins(tree[0], subquery_joins, True)
+    return
+
+
+# Heuristic 5: adds projections throughout the query tree
+def push_projections_down(root):
+    if "PROJECTION" not in str(root.data):
+        add_projections(root.children[0], {})
+    else:
+        add_projections(root, {})
+    return
+
+
+# Runs all of the heuristics on one query block and returns the root of its query tree.
+# Subqueries are optimized on their own and joined back in as semi, anti or aggregate joins.
+# When a costs dictionary is given the estimated cost after each step is added to it.
+# When a budget is given and runs out, the plan after the last finished step is returned with its
+# cartesians and selections merged into joins, and the budget records the step that ran out.
+# A block too deep to even build its canonical tree is returned as one unoptimized QUERY BLOCK node
+def optimize_block(expression, show=True, catalog=None, feedback=None, costs=None, budget=None):
+    catalog = {} if catalog is None else catalog
+    feedback = {} if feedback is None else feedback
+    previous_budget = set_active_budget(budget)
+
+    try:
+        block, subquery_joins = unnest_subqueries(expression)
+        # The subqueries are optimized first, their trees are joined in when the selections are pushed down
+        subquery_joins = [(label, conditions, None if sub_select is None else optimize_query(sub_select, False, catalog, feedback, None, budget), inner_aliases) for label, conditions, sub_select, inner_aliases in subquery_joins]
+        starting_arr = [block.args.get("order"), find_projection(block), block.args.get("having"), block.args.get("group"), block.args.get("where")]
+        join_arr = find_joins(block)
+        tables = find_tables(block)
+
+        tree = build_canonical(starting_arr, tables)
+        if join_arr and "JOIN" in join_arr[0]:
+            insert_joins(tree[0], join_arr)
+        canonical = copy_tree(tree[0])
+    except (BudgetExceeded, RecursionError) as error:
+        reason = str(error) if isinstance(error, BudgetExceeded) else "recursion"
+        if budget is not None and budget.exceeded is None:
+            budget.exceeded = "canonical"
+        root = Node("QUERY BLOCK " + expression.sql())
+        if show:
+            print("BUDGET EXCEEDED (" + reason + ") during canonical, the query block is left unoptimized\n")
+        print_stage("---------------FALLBACK QUERY TREE----------------", root, show)
+        # Its cost is unknown, so it is never preferred
+        if costs is not None:
+            costs.update({stage: float("inf") for stage in COST_STAGES})
+        set_active_budget(previous_budget)
+        return root
+
+    # Print the canonical query tree
+    print_stage("---------------CANONICAL QUERY TREE---------------", tree[0], show)
+    record_stage_cost(costs, "canonical", tree[0], catalog, feedback, subquery_joins)
+
+    stages = [
+        # Perform the cascade of selections
+        ("cascade", "--------HEURISTIC 1: CASCADE OF SELECTIONS--------", lambda: cascade_selection(tree[0])),
+        # Perform the moving down of selections as low as possible
+        ("pushdown", "--------HEURISTIC 2: PUSH SELECTIONS DOWN---------", lambda: push_selections_down(tree, subquery_joins)),
+        # Apply the most restrictive selections first
+        ("selectivity", "-----HEURISTIC 3: Smallest Selectivity First------", lambda: order_by_selectivity(tree[0], catalog, feedback)),
+        # Merge selections and cartesians into joins
+        ("joins", "----HEURISTIC 4: Replace Cartesian + Selection----", lambda: create_joins(tree[0])),
+        # Add projection throughout the query tree
+        ("projections", "--------HEURISTIC 5: Push Projections Down--------", lambda: push_projections_down(tree[0])),
+    ]
+    root = tree[0]
+    for index, (stage, title, run) in enumerate(stages):
+        saved = copy_tree(root)
+        try:
+            run()
+        except (BudgetExceeded, RecursionError) as error:
+            reason = str(error) if isinstance(error, BudgetExceeded) else "recursion"
+            if budget is not None and budget.exceeded is None:
+                budget.exceeded = stage
+            root = fallback_plan(canonical if index < 2 else saved, index < 2, index < 4, subquery_joins)
+            if show:
+                print("BUDGET EXCEEDED (" + reason + ") during " + stage + ", falling back to the cheap heuristic plan\n")
+            print_stage("---------------FALLBACK QUERY TREE----------------", root, show)
+            for remaining, title, run in stages[index:]:
+                record_stage_cost(costs, remaining, root, catalog, feedback)
+            break
+        print_stage(title, root, show)
+        record_stage_cost(costs, stage, root, catalog, feedback, subquery_joins if index < 1 else ())
+
+    set_active_budget(previous_budget)
+    return root
+
+
+# Builds the cheap plan used when the budget runs out. When the selections were not pushed down yet the
+# canonical tree becomes a join chain (see chain_joins), otherwise the selections above cartesians become
+# joins if that step was not reached. Then the subquery trees are joined in above the join tree if the
+# selections were not pushed down yet. None of this spends from the budget
+def fallback_plan(root, attach_subqueries, merge_joins, subquery_joins):
+    previous_budget = set_active_budget(None)
+    if attach_subqueries and chain_joins(root):
+        pass
+    elif merge_joins:
+        try:
+            create_joins(root)
+        except RecursionError:
+            # A tree too deep to walk keeps the joins that were merged before the limit
+            pass
+    if attach_subqueries:
+        attach_subquery_joins(root, subquery_joins, False)
+    set_active_budget(previous_budget)
+    return root
+
+
+# Turns the WHERE selection and cartesians of a canonical tree into a join chain in one pass, so it
+# needs no budget: the tables are joined in FROM order and each conjunct of the WHERE clause goes
+# above its table, or on the first join that has all of its tables. Returns False and leaves the
+# tree as it is when it already has joins of its own or the WHERE clause can not be split
+def chain_joins(root):
+    select_node = root
+    while select_node.children and not str(select_node.data).startswith("SELECT"):
+        select_node = select_node.children[0]
+    if not str(select_node.data).startswith("SELECT") or len(select_node.children) != 1:
+        return False
+
+    # The tables in FROM order, below nothing but cartesians
+    leaf_nodes = []
+    stack = [select_node.children[0]]
+    while stack:
+        tree_node = stack.pop()
+        if not tree_node.children:
+            leaf_nodes.append(tree_node)
+        elif tree_node.data == "X":
+            stack += reversed(tree_node.children)
+        else:
+            return False
+    try:
+        conjuncts = split_conjuncts(exp.condition(str(select_node.data)[len("SELECT"):]))
+    except sqlglot.errors.ParseError:
+        return False
+
+    aliases = [find_alias(leaf.data) for leaf in leaf_nodes]
+    selections = {alias: [] for alias in aliases}
+    joins = [[] for alias in aliases]
+    remaining = []
+    for conjunct in conjuncts:
+        used = {column.table for column in conjunct.find_all(exp.Column)} & set(aliases)
+        if len(used) == 1:
+            selections[used.pop()].append(conjunct.sql())
+        elif used:
+            joins[max(aliases.index(alias) for alias in used)].append(conjunct.sql())
+        else:
+            remaining.append(conjunct.sql())
+
+    top_node = None
+    for index, leaf in enumerate(leaf_nodes):
+        branch = leaf
+        for condition in selections[aliases[index]]:
+            select_branch = Node("SELECT " + condition)
+            select_branch.add_child(branch)
+            branch = select_branch
+        if top_node is None:
+            top_node = branch
+            continue
+        join_node = Node("JOIN " + " AND ".join(joins[index]) if joins[index] else "X")
+        join_node.add_child(top_node)
+        join_node.add_child(branch)
+        top_node = join_node
+    for condition in remaining:
+        select_top = Node("SELECT " + condition)
+        select_top.add_child(top_node)
+        top_node = select_top
+
+    replace_node(select_node, top_node)
+    return True
+
+
+# Optimizes independent query blocks concurrently in threads and returns [(root, costs)] in the same
+# order. The optimizer is pure Python, so the GIL keeps the threads from using more than one CPU
+def optimize_blocks_concurrently(expressions, catalog, feedback, keep_costs, budget, workers):
+    def optimize(expression):
+        costs = {} if keep_costs else None
+        root = optimize_query(expression, False, catalog, feedback, costs, budget, workers)
+        return root, costs
+
+    if len(expressions) < 2:
+        return [optimize(expression) for expression in expressions]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(optimize, expressions))
+
+
+# Adds the costs of a block to the costs of the whole query, step by step
+def add_costs(costs, block_costs):
+    if costs is not None and block_costs is not None:
+        for stage, cost in block_costs.items():
+            costs[stage] = costs.get(stage, 0) + cost
+    return
+
+
+# Replaces the leaves that scan a CTE or derived table with its tree. A CTE used more than once
+# is only scanned here, its tree is materialized once at the top of the query
+def substitute_blocks(tree_node, block_trees, shared):
+    if not tree_node.children:
+        name = str(tree_node.data).split(' AS ')[0].strip().lower()
+        if name in shared:
+            replace_node(tree_node, Node("SCAN CTE " + str(tree_node.data)))
+        elif name in block_trees:
+            label, root = block_trees[name]
+            new_node = Node(label + " AS " + find_alias(tree_node.data))
+            new_node.add_child(root)
+            replace_node(tree_node, new_node)
+            substitute_blocks(root, block_trees, shared)
+        return
+    for child_node in list(tree_node.children):
+        substitute_blocks(child_node, block_trees, shared)
+    return
+
+
+# Optimizes a whole query and returns the root of its tree. Every query block becomes its own
+# tree: the CTEs, the sides of a UNION, INTERSECT or EXCEPT and the derived tables in FROM.
+# The independent blocks are optimized concurrently in threads, and a CTE used more than once is planned
+# once and shared. A query with one block is the same as optimize_block
+def optimize_query(expression, show=True, catalog=None, feedback=None, costs=None, budget=None, workers=None):
+    catalog = {} if catalog is None else catalog
+    # A parenthesized query, e.g. a side of (SELECT ...) EXCEPT (SELECT ...), is planned as the query inside
+    while isinstance(expression, exp.Subquery):
+        expression = expression.this
+    expression = expression.copy()
+
+    # Take the CTEs off of the query
+    ctes = []
+    with_node = expression.find(exp.With)
+    if with_node is not None and with_node.parent is expression:
+        ctes = [(cte.alias.lower(), cte.this) for cte in with_node.expressions]
+        with_node.pop()
+
+    # Replace the derived tables in FROM with tables that stand in for them
+    derived = []
+    if isinstance(expression, exp.Select):
+        for subquery in list(expression.find_all(exp.Subquery)):
+            if isinstance(subquery.parent, (exp.From, exp.Join)) and in_block(subquery, expression):
+                name = "derived" + str(len(derived) + 1)
+                derived.append((name, subquery.this, subquery.alias))
+                subquery.replace(exp.alias_(exp.to_table(name.upper()), subquery.alias, table=True))
+
+    if not ctes and not derived and isinstance(expression, exp.Select):
+        return optimize_block(expression, show, catalog, feedback, costs, budget)
+
+    # The blocks are known to the catalog by their output attributes
+    blocks = ctes + [(name, body) for name, body, alias in derived]
+    catalog = dict(catalog)
+    for name, body in blocks:
+        catalog[name] = {"attributes": [a.lower() for a in body.named_selects], "keys": []}
+
+    # A CTE used more than once is materialized and shared
+    queries = [expression] + [body for name, body in blocks]
+    uses = {name: 0 for name, body in ctes}
+    for query in queries:
+        for table in query.find_all(exp.Table):
+            if table.name.lower() in uses:
+                uses[table.name.lower()] += 1
+    shared = [name for name, body in ctes if uses[name] > 1]
+
+    # Optimize the blocks concurrently, the sides of a set operation are blocks too
+    if isinstance(expression, exp.SetOperation):
+        sides = [expression.this, expression.expression]
+    else:
+        sides = []
+    results = optimize_blocks_concurrently([body for name, body in blocks] + sides, catalog, feedback, costs is not None, budget, workers)
+    for root, block_costs in results:
+        add_costs(costs, block_costs)
+    block_trees = {}
+    for (name, body), (root, block_costs) in zip(blocks, results):
+        block_trees[name] = ("CTE " + name.upper() if name in uses else "DERIVED TABLE", root)
+
+    if isinstance(expression, exp.SetOperation):
+        label = expression.key.upper()
+        if isinstance(expression, exp.Union) and not expression.args.get("distinct"):
+            label += " ALL"
+        root = Node(label)
+        for side, block_costs in results[len(blocks):]:
+            root.add_child(side)
+        if expression.args.get("order") is not None:
+            order_node = Node(expression.args["order"])
+            order_node.add_child(root)
+            root = order_node
+    else:
+        block_costs = {} if costs is not None else None
+        root = optimize_block(expression, show, catalog, feedback, block_costs, budget)
+        add_costs(costs, block_costs)
+
+    substitute_blocks(root, block_trees, shared)
+    if shared:
+        with_root = Node("WITH")
+        for name in shared:
+            materialize = Node("MATERIALIZE CTE " + name.upper())
+            materialize.add_child(block_trees[name][1])
+            substitute_blocks(block_trees[name][1], block_trees, shared)
+            with_root.add_child(materialize)
+        with_root.add_child(root)
+        root = with_root
+
+    print_stage("-----------------FULL QUERY TREE------------------", root, show)
+    return root
+
+
+# Checks if a node is a plain join or cartesian that can start a shareable join core
+def is_join_core(tree_node):
+    data = str(tree_node.data).strip()
+    return data == "X" or data.startswith("JOIN")
+
+
+# Turns a condition into a form without aliases, e.g. "E.Ssn = W.Essn" with E -> Employee and W -> Works_On
+# gives "employee.ssn = works_on.essn". The sides of an equality are sorted so both orders match
+def normalize_condition(condition, alias_map):
+    # Only the names are replaced and case-insensitive, the string literals are kept as they are
+    parts = re.split(r"('(?:[^']|'')*')", condition)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\b([A-Za-z_]\w*)\.", lambda m: alias_map.get(m.group(1), m.group(1)) + ".", parts[i])
+        parts[i] = re.sub(r"\s+", " ", parts[i].lower())
+    condition = "".join(parts).strip()
+    parts = [" = ".join(sorted(p.strip().split(" = "))) if p.count(" = ") == 1 else p.strip() for p in condition.split(" and ")]
+    return " and ".join(sorted(parts))
+
+
+# Returns the normalized form of a join core, or None if the subtree can not be shared.
+# Projections are skipped since they only depend on what the rest of the query needs.
+# When a selections list is given the selections are left out of the form and collected into it
+def normalize_subtree(tree_node, alias_map, selections=None):
+    data = str(tree_node.data).strip()
+    if data.startswith("PROJECTION") and tree_node.children:
+        return normalize_subtree(tree_node.children[0], alias_map, selections)
+    if not tree_node.children:
+        return data.split(' AS ')[0].lower()
+    if is_join_core(tree_node):
+        label = "join " + normalize_condition(data[len("JOIN"):], alias_map) if data != "X" else "x"
+    elif data.startswith("SELECT"):
+        label = "select " + normalize_condition(data[len("SELECT"):], alias_map)
+        if selections is not None:
+            selections.append((label, data))
+            return normalize_subtree(tree_node.children[0], alias_map, selections)
+    else:
+        return None
+
+    children = []
+    for child_node in tree_node.children:
+        child = normalize_subtree(child_node, alias_map, selections)
+        if child is None:
+            return None
+        children.append(child)
+
+    # Joins and cartesians are commutative so the children are sorted
+    return label + "(" + ",".join(sorted(children)) + ")"
+
+
+# Maps the aliases of the tables under a node to their lowercase table names
+def find_alias_map(tree_node):
+    leaf_nodes = []
+    find_leaves(tree_node, leaf_nodes)
+    return {find_alias(leaf.data): str(leaf.data).split(' AS ')[0].strip().lower() for leaf in leaf_nodes}
+
+
+# Hashes a join core. Returns None if it is not a join core or it uses a table twice
+def hash_join_core(tree_node, selections=None):
+    if not is_join_core(tree_node):
+        return None
+    leaf_nodes = []
+    find_leaves(tree_node, leaf_nodes)
+    alias_map = find_alias_map(tree_node)
+    if len(set(alias_map.values())) != len(leaf_nodes):
+        return None
+    normalized = normalize_subtree(tree_node, alias_map, selections)
+    if normalized is None:
+        return None
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+# Collects the hash of every join core in a tree into the occurrences dictionary
+def collect_join_cores(tree_node, query_index, occurrences, hashes):
+    core_hash = hash_join_core(tree_node)
+    if core_hash is not None:
+        occurrences.setdefault(core_hash, []).append((query_index, tree_node))
+        hashes[id(tree_node)] = core_hash
+    for child_node in tree_node.children:
+        collect_join_cores(child_node, query_index, occurrences, hashes)
+    return
+
+
+# Replaces a node in the tree with a new node at the same position
+def replace_node(old_node, new_node):
+    parent = old_node.parent
+    index = parent.children.index(old_node)
+    parent.children[index] = new_node
+    new_node.parent = parent
+    old_node.parent = None
+    return
+
+
+# Returns the qualified attributes the query uses outside of the given subtree
+def attributes_used_outside(root, subtree):
+    attributes = []
+    if root is subtree:
+        return attributes
+    attributes += find_attributes(root.data)
+    for child_node in root.children:
+        attributes += attributes_used_outside(child_node, subtree)
+    return attributes
+
+
+# Finds the materialized view declarations in the schema, e.g.
+# MATERIALIZED VIEW Emp_Work AS SELECT * FROM Employee E, Works_On W WHERE E.Ssn = W.Essn;
+def find_views(schema):
+    views = {}
+    for name, query in re.findall(r"MATERIALIZED\s+VIEW\s+(\w+)\s+AS\s+(SELECT\b.*?)(?:;|$)", schema, re.IGNORECASE | re.DOTALL):
+        views[name] = sqlglot.parse_one(query)
+    return views
+
+
+# Splits the data of a selection or join node into its conditions
+def node_conditions(node_data):
+    data = re.sub(r"^(JOIN|SELECT)\b", "", str(node_data).strip())
+    return [part.strip() for part in re.split(r"\bSELECT\b|\bAND\b", data) if part.strip()]
+
+
+# Checks if a node joins tables, a join, a cartesian or a selection over more than one table
+def is_join_step(tree_node):
+    data = str(tree_node.data).strip()
+    return is_join_core(tree_node) or (data.startswith("SELECT") and len(condition_aliases(data)) > 1 and bool(tree_node.children))
+
+
+# Splits the join part of a tree into branches (a table with the selections and projections above it,
+# or any other subtree) and the conditions of its joins and join selections
+def collect_join_region(tree_node, branches, conditions):
+    data = str(tree_node.data).strip()
+    if data.startswith("PROJECTION") and tree_node.children and is_join_step(tree_node.children[0]):
+        collect_join_region(tree_node.children[0], branches, conditions)
+    elif is_join_step(tree_node):
+        if data != "X":
+            conditions += node_conditions(data)
+        for child_node in tree_node.children:
+            collect_join_region(child_node, branches, conditions)
     else:
-        add_projections(tree[0], {})
-    print("--------HEURISTIC 5: Push Projections Down--------")
-    print_tree(tree[0], 0)
-    print("--------------------------------------------------\n")
+        branches.append(tree_node)
+    return
+
+
+# Takes a branch and returns (alias, table name, selections) if it is a table with only selections
+# and projections above it, otherwise None
+def branch_table(branch):
+    selections = []
+    tree_node = branch
+    while tree_node.children:
+        data = str(tree_node.data).strip()
+        if data.startswith("SELECT") and len(tree_node.children) == 1:
+            selections += node_conditions(data)
+        elif not data.startswith("PROJECTION") or len(tree_node.children) != 1:
+            return None
+        tree_node = tree_node.children[0]
+    return find_alias(tree_node.data), str(tree_node.data).split(' AS ')[0].strip().lower(), selections
+
+
+# Describes the tables of a join region by their aliases, or returns None if a table is used twice
+def region_tables(branches):
+    tables = {}
+    for branch in branches:
+        table = branch_table(branch)
+        if table is not None:
+            if table[1] in [t[1] for t in tables.values()]:
+                return None
+            tables[id(branch)] = table
+    return tables
+
+
+# Returns the alias mapping a scan of a view or subplan is read with, e.g. " (X=E, Y=W)" when the query
+# calls the tables X and Y and the view or subplan calls them E and W. Empty when the aliases are the same
+def alias_mapping(query_aliases, scan_aliases):
+    pairs = [alias + "=" + scan_aliases[table] for alias, table in sorted(query_aliases.items()) if table in scan_aliases and scan_aliases[table] != alias]
+    return " (" + ", ".join(pairs) + ")" if pairs else ""
+
+
+# Optimizes the views and returns (name, tables, join conditions, selections, projected attributes or None for *,
+# aliases), with the conditions normalized and the aliases mapping table names to the view's aliases.
+# Views with grouping or aggregates, or that use a table twice, can not stand in for joins and are skipped
+def prepare_views(views, catalog, feedback):
+    prepared = []
+    for name, expression in views.items():
+        if not isinstance(expression, exp.Select) or expression.args.get("group") is not None or expression.find(exp.AggFunc) is not None:
+            continue
+        root = optimize_block(expression, False, catalog, feedback)
+        core = root
+        while not is_join_step(core) and core.children and str(core.data).startswith(("PROJECTION", "ORDER")):
+            core = core.children[0]
+        branches = []
+        conditions = []
+        collect_join_region(core, branches, conditions)
+        tables = region_tables(branches)
+        if tables is None or len(tables) != len(branches):
+            continue
+        alias_map = find_alias_map(core)
+        selections = {normalize_condition(c, alias_map) for alias, table, chain in tables.values() for c in chain}
+        join_conditions = {normalize_condition(c, alias_map) for c in conditions}
+        if any(isinstance(p, exp.Star) for p in expression.expressions):
+            attributes = None
+        else:
+            attributes = {normalize_condition(p.sql(), alias_map) for p in expression.expressions}
+        aliases = {table: alias for alias, table, chain in tables.values()}
+        prepared.append((name, set(aliases), join_conditions, selections, attributes, aliases))
+    # Views over more tables are tried first
+    prepared.sort(key=lambda view: len(view[1]), reverse=True)
+    return prepared
+
+
+# Replaces the tables of a join region that a materialized view covers with a scan of the view, joined with
+# the rest of the region. The view is matched on the tables and conditions of the region, so it does not
+# matter how the joins were ordered. Selections and join conditions of the query that the view does not
+# apply stay above the scan
+def match_views(tree_node, root, prepared_views):
+    if not is_join_step(tree_node) or tree_node.parent is None:
+        for child_node in list(tree_node.children):
+            match_views(child_node, root, prepared_views)
+        return
+
+    branches = []
+    conditions = []
+    collect_join_region(tree_node, branches, conditions)
+    tables = region_tables(branches)
+    alias_map = find_alias_map(tree_node)
+    for name, view_tables, view_joins, view_selections, attributes, view_aliases in prepared_views if tables else []:
+        covered = [branch for branch in branches if id(branch) in tables and tables[id(branch)][1] in view_tables]
+        if len(covered) != len(view_tables):
+            continue
+        covered_aliases = {tables[id(branch)][0] for branch in covered}
+        inside = [c for c in conditions if condition_aliases(c) <= covered_aliases]
+        selections = [c for branch in covered for c in tables[id(branch)][2]]
+
+        # Every condition of the view has to be in the query, or the view is missing rows
+        if not view_joins <= {normalize_condition(c, alias_map) for c in inside}:
+            continue
+        if not view_selections <= {normalize_condition(c, alias_map) for c in selections}:
+            continue
+        residual = [c for c in inside if normalize_condition(c, alias_map) not in view_joins]
+        residual += [c for c in selections if normalize_condition(c, alias_map) not in view_selections]
+        pending = [c for c in conditions if c not in inside]
+
+        # The view has to keep every attribute the rest of the query and the remaining conditions use
+        used = attributes_used_outside(root, tree_node) + find_attributes(" ".join(residual + pending))
+        needed = {normalize_condition(a, alias_map) for a in used if a.split('.')[0] in covered_aliases}
+        if attributes is not None and not needed <= attributes:
+            continue
+
+        query_aliases = {alias: table for alias, table in alias_map.items() if alias in covered_aliases}
+        top_node = Node("SCAN VIEW " + name + alias_mapping(query_aliases, view_aliases))
+        for data in residual:
+            select_node = Node("SELECT " + data)
+            select_node.add_child(top_node)
+            top_node = select_node
+
+        # Join the other branches back in, preferring branches joined to what is placed
+        placed = set(covered_aliases)
+        remaining = [branch for branch in branches if branch not in covered]
+        while remaining:
+            connected = [b for b in remaining if any(condition_aliases(c) & placed and condition_aliases(c) & set(find_alias_map(b)) for c in pending)]
+            branch = connected[0] if connected else remaining[0]
+            remaining.remove(branch)
+            placed |= set(find_alias_map(branch))
+            joined = [c for c in pending if condition_aliases(c) <= placed]
+            pending = [c for c in pending if c not in joined]
+            join_node = Node("JOIN " + " AND ".join(joined) if joined else "X")
+            join_node.add_child(top_node)
+            join_node.add_child(branch)
+            top_node = join_node
+        for data in pending:
+            select_node = Node("SELECT " + data)
+            select_node.add_child(top_node)
+            top_node = select_node
+
+        replace_node(tree_node, top_node)
+        tree_node = top_node
+        branches = [branch for branch in branches if branch not in covered]
+        break
+
+    for branch in branches:
+        match_views(branch, root, prepared_views)
+    return
+
+
+# Removes the projections inside a subtree
+def strip_projections(tree_node):
+    for child_node in list(tree_node.children):
+        while str(child_node.data).startswith("PROJECTION") and child_node.children:
+            grandchild = child_node.children[0]
+            child_node.remove_child(grandchild)
+            replace_node(child_node, grandchild)
+            child_node = grandchild
+        strip_projections(child_node)
+    return
+
+
+# Finds the join cores shared by the queries of a batch. Only the largest shared cores are kept,
+# the first use of each is materialized and every other use becomes a scan of it.
+# Returns a list of (subplan number, core hash, query numbers, materialized node)
+def share_subplans(trees):
+    occurrences = {}
+    hashes = {}
+    for index, root in enumerate(trees):
+        collect_join_cores(root, index, occurrences, hashes)
+    shared = {h for h, uses in occurrences.items() if len(uses) > 1}
+
+    # A shared core inside a bigger shared core is reused through the bigger one
+    maximal = []
+    for core_hash, uses in occurrences.items():
+        if core_hash not in shared:
+            continue
+        covered = True
+        for query_index, tree_node in uses:
+            ancestor = tree_node.parent
+            while ancestor is not None and hashes.get(id(ancestor)) not in shared:
+                ancestor = ancestor.parent
+            if ancestor is None:
+                covered = False
+        if not covered:
+            maximal.append(core_hash)
+
+    # Bigger cores are replaced first, a use inside a core that was already replaced is gone from its query
+    def core_size(core_hash):
+        leaf_nodes = []
+        find_leaves(occurrences[core_hash][0][1], leaf_nodes)
+        return len(leaf_nodes)
+
+    def in_query(query_index, tree_node):
+        while tree_node.parent is not None:
+            tree_node = tree_node.parent
+        return tree_node is trees[query_index]
+
+    subplans = []
+    for core_hash in sorted(maximal, key=core_size, reverse=True):
+        uses = [(query_index, tree_node) for query_index, tree_node in occurrences[core_hash] if in_query(query_index, tree_node)]
+        if len(uses) < 2:
+            continue
+        number = len(subplans) + 1
+        first = uses[0][1]
+
+        # The materialized subplan has to keep the attributes every use needs, named with the first use's aliases
+        first_aliases = {table: alias for alias, table in find_alias_map(first).items()}
+        needed = []
+        for query_index, tree_node in uses:
+            alias_map = find_alias_map(tree_node)
+            for att in attributes_used_outside(trees[query_index], tree_node):
+                alias, attribute = att.split('.', 1)
+                if alias in alias_map:
+                    needed.append(first_aliases[alias_map[alias]] + "." + attribute)
+
+        materialize = Node("MATERIALIZE SUBPLAN " + str(number))
+        materialize.insert_node(first.parent, first)
+        # A scan records which of its aliases are which of the subplan's, the query above it keeps its own aliases
+        for query_index, tree_node in uses[1:]:
+            replace_node(tree_node, Node("SCAN SUBPLAN " + str(number) + alias_mapping(find_alias_map(tree_node), first_aliases)))
+
+        # Push the combined projection back down through the shared subplan
+        strip_projections(materialize)
+        if needed:
+            projection = Node("PROJECTION " + " ".join(sorted(set(needed))))
+            projection.insert_node(materialize, first)
+            add_projections(projection, {})
+        subplans.append((number, core_hash, sorted({q + 1 for q, n in uses}), first))
+
+    return subplans
+
+
+# Takes the input files as arguments, input1.txt is used when none are given.
+# With --share the queries are optimized as one batch and their common join cores are reused.
+# --record-costs FILE saves the cost of every query after each step, and --check-costs FILE
+# compares against the saved costs and exits with an error when a query got worse.
+# --budget-ms N, --budget-nodes N and --budget-bytes N limit the optimization of each query.
+# --data DIR estimates selectivities from samples of the relations' CSV or Parquet files in DIR
+def main():
+    args = sys.argv[1:]
+    share = "--share" in args
+    record_costs = None
+    check_costs = None
+    limits = {}
+    data_directory = None
+    files = []
+    i = 0
+    while i < len(args):
+        if args[i] == "--record-costs":
+            record_costs = args[i + 1]
+            i += 1
+        elif args[i] == "--check-costs":
+            check_costs = args[i + 1]
+            i += 1
+        elif args[i] == "--data":
+            data_directory = args[i + 1]
+            i += 1
+        elif args[i] in ("--budget-ms", "--budget-nodes", "--budget-bytes"):
+            limits[args[i]] = int(args[i + 1])
+            i += 1
+        elif args[i] != "--share":
+            files.append(args[i])
+        i += 1
+    files = files or ["input1.txt"]
+
+    # Plan quality harness
+    if record_costs or check_costs:
+        results = corpus_costs(files)
+        print_costs(results)
+        if record_costs:
+            with open(record_costs, "w") as file:
+                json.dump(results, file, indent=2)
+        if check_costs:
+            with open(check_costs, "r") as file:
+                baseline = json.load(file)
+            regressions = find_cost_regressions(results, baseline)
+            for file_name, old_cost, new_cost in regressions:
+                print("REGRESSION " + file_name + ": final cost %.0f -> %.0f" % (old_cost, new_cost))
+            if regressions:
+                sys.exit(1)
+        return
+
+    queries = []
+    views = {}
+    catalog = {}
+    for file_name in files:
+        with open(file_name, "r") as file:
+            input = file.read()
+            schema, query = input.split("-- SQL Query --")
+        views.update(find_views(schema))
+        catalog.update(parse_schema(schema))
+        queries.append((file_name, query))
+
+    # Samples of the data files, see load_samples
+    if data_directory:
+        load_samples(catalog, data_directory)
+
+    # Selectivities learned from executed plans, see record_feedback
+    feedback = load_feedback()
+    prepared_views = prepare_views(views, catalog, feedback)
+
+    trees = []
+    for file_name, query in queries:
+        if len(queries) > 1:
+            print("=================== " + file_name + " ===================\n")
+        expression = sqlglot.parse_one(query)
+        budget = None
+        if limits:
+            budget = Budget(limits.get("--budget-ms"), limits.get("--budget-nodes"), limits.get("--budget-bytes"))
+        root = optimize_query(expression, True, catalog, feedback, None, budget)
+        if budget is not None:
+            budget.close()
+            # Subqueries, CTEs and set operation sides are optimized without printing, so the
+            # fallback is reported here for every block of the query
+            if budget.exceeded is not None:
+                print("BUDGET EXCEEDED: " + file_name + " ran out during " + budget.exceeded + ", the tree above uses fallback plans\n")
+
+        # Use the materialized views that cover parts of the query
+        if prepared_views:
+            match_views(root, root, prepared_views)
+            print_stage("-------------MATERIALIZED VIEW MATCHING-----------", root, True)
+        trees.append(root)
+
+    if share and len(trees) > 1:
+        print("=================== SHARED SUBPLANS ===================\n")
+        for number, core_hash, query_numbers, tree_node in share_subplans(trees):
+            print("SUBPLAN " + str(number) + " (" + core_hash + ") used by queries " + ", ".join(str(q) for q in query_numbers))
+            print_tree(tree_node, 0)
+            print()
+        for file_name, root in zip(files, trees):
+            print_stage("------" + file_name + " WITH SHARED SUBPLANS------", root, True)
 
     return
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
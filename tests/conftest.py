@@ -0,0 +1,40 @@
+import os
+import sys
+
+import sqlglot
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import main
+
+INPUTS = os.path.join(os.path.dirname(__file__), "inputs")
+
+
+# Reads an input file and returns its schema and query
+def read_input(file_name):
+    with open(os.path.join(INPUTS, file_name), "r") as file:
+        return file.read().split("-- SQL Query --")
+
+
+# Optimizes a query against the schema of an input file and returns the root of its tree
+def optimize_sql(query, schema_file="two_outer_tables.txt", costs=None, budget=None):
+    schema = read_input(schema_file)[0]
+    return main.optimize_query(sqlglot.parse_one(query), False, main.parse_schema(schema), {}, costs, budget)
+
+
+# Optimizes one of the regression inputs and returns the root of its tree
+def optimize_input(file_name, costs=None, budget=None):
+    schema, query = read_input(file_name)
+    return main.optimize_query(sqlglot.parse_one(query), False, main.parse_schema(schema), {}, costs, budget)
+
+
+# Returns every node of a tree, parents before their children
+def all_nodes(tree_node):
+    nodes = [tree_node]
+    for child_node in tree_node.children:
+        nodes += all_nodes(child_node)
+    return nodes
+
+
+# Returns the data of every node of a tree as strings
+def all_datas(tree_node):
+    return [str(node.data) for node in all_nodes(tree_node)]
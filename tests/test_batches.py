@@ -0,0 +1,72 @@
+import main
+from conftest import all_datas, all_nodes, optimize_input, optimize_sql, read_input
+
+EMP_WORK = "MATERIALIZED VIEW Emp_Work AS SELECT * FROM Employee E, Works_On W WHERE E.Ssn = W.Essn;"
+
+
+# Optimizes a query, then replaces what the views cover and returns the root
+def optimize_with_views(query, view_declarations):
+    schema = read_input("two_outer_tables.txt")[0] + view_declarations
+    catalog = main.parse_schema(schema)
+    prepared_views = main.prepare_views(main.find_views(schema), catalog, {})
+    root = optimize_sql(query)
+    main.match_views(root, root, prepared_views)
+    return root
+
+
+# A view is matched on the joined tables and conditions, even when the plan joins them in another order
+def test_view_matches_reordered_joins():
+    root = optimize_with_views("SELECT E.Lname FROM Employee E, Works_On W, Project P WHERE E.Ssn = W.Essn AND W.Pno = P.Pnumber AND P.Pname = 'X' AND E.Salary > 5", EMP_WORK)
+    datas = all_datas(root)
+    assert "SCAN VIEW Emp_Work" in datas
+    assert datas[1] == "JOIN W.Pno = P.Pnumber"
+    assert "SELECT E.Salary > 5" in datas
+    assert not any(data.endswith(("Employee AS E", "Works_On AS W")) for data in datas)
+
+
+# A scan of a view lists the query's aliases for the view's tables
+def test_view_scan_maps_aliases():
+    root = optimize_with_views("SELECT M.Fname FROM Works_On N, Employee M WHERE N.Essn = M.Ssn AND N.Hours > 5", EMP_WORK)
+    assert all_datas(root) == ["PROJECTION M.Fname", "SELECT N.Hours > 5", "SCAN VIEW Emp_Work (M=E, N=W)"]
+
+
+# A view that drops an attribute the query needs, or misses one of its selections, is not used
+def test_view_rejected_when_it_drops_an_attribute():
+    view = "MATERIALIZED VIEW Emp_Work AS SELECT E.Lname, W.Essn FROM Employee E, Works_On W WHERE E.Ssn = W.Essn;"
+    root = optimize_with_views("SELECT E.Lname FROM Employee E, Works_On W, Project P WHERE E.Ssn = W.Essn AND W.Pno = P.Pnumber", view)
+    assert not any(data.startswith("SCAN VIEW") for data in all_datas(root))
+
+    view = "MATERIALIZED VIEW Emp_Work AS SELECT * FROM Employee E, Works_On W WHERE E.Ssn = W.Essn AND W.Hours > 10;"
+    root = optimize_with_views("SELECT E.Lname FROM Employee E, Works_On W WHERE E.Ssn = W.Essn", view)
+    assert not any(data.startswith("SCAN VIEW") for data in all_datas(root))
+
+
+# Adding projections keeps the preserved side of a left outer join as its first input
+def test_left_join_child_order():
+    root = optimize_input("left_join_order.txt")
+    join = [node for node in all_nodes(root) if str(node.data).startswith("LEFT OUTER JOIN")][0]
+    leaves = []
+    main.find_leaves(join.children[0], leaves)
+    assert [main.find_alias(leaf.data) for leaf in leaves] == ["E"]
+
+
+# Join cores hash the same whatever their aliases and the order of their inputs, but not with other conditions
+def test_join_core_hash_ignores_aliases_and_input_order():
+    first = optimize_sql("SELECT E.Lname FROM Employee E, Works_On W WHERE E.Ssn = W.Essn")
+    second = optimize_sql("SELECT Y.Hours FROM Works_On Y, Employee X WHERE Y.Essn = X.Ssn")
+    other = optimize_sql("SELECT E.Lname FROM Employee E, Works_On W WHERE E.Ssn = W.Pno")
+    assert main.hash_join_core(first.children[0]) == main.hash_join_core(second.children[0])
+    assert main.hash_join_core(first.children[0]) != main.hash_join_core(other.children[0])
+
+
+# A shared join core is materialized once, and the other query scans it with its own aliases mapped
+def test_shared_subplan_scan_maps_aliases():
+    trees = [
+        optimize_sql("SELECT E.Lname FROM Employee E, Works_On W WHERE E.Ssn = W.Essn"),
+        optimize_sql("SELECT Y.Hours FROM Employee X, Works_On Y WHERE X.Ssn = Y.Essn"),
+    ]
+    subplans = main.share_subplans(trees)
+    assert [(number, queries) for number, core_hash, queries, tree_node in subplans] == [(1, [1, 2])]
+    assert all_datas(trees[0])[1] == "MATERIALIZE SUBPLAN 1"
+    assert all_datas(trees[1]) == ["PROJECTION Y.Hours", "SCAN SUBPLAN 1 (X=E, Y=W)"]
+    assert all_datas(trees[0])[2] == "PROJECTION E.Lname W.Hours"
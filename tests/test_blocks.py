@@ -0,0 +1,10 @@
+from conftest import optimize_input
+
+
+# The sides of a parenthesized set operation are planned as their own query blocks
+def test_parenthesized_union():
+    root = optimize_input("parenthesized_union.txt")
+    assert root.data == "UNION"
+    assert [str(side.data) for side in root.children] == ["PROJECTION E.Ssn", "PROJECTION W.Essn"]
+    for side in root.children:
+        assert side.children
@@ -0,0 +1,31 @@
+import main
+from conftest import all_datas, all_nodes, optimize_input, optimize_sql
+
+
+# A budget that runs out still gives a plan without cartesians
+def test_budget_fallback_merges_joins():
+    budget = main.Budget(nodes=1)
+    root = optimize_input("two_outer_tables.txt", budget=budget)
+    assert budget.exceeded is not None
+    assert "X" not in all_datas(root)
+
+
+# The fallback joins three tables in a chain with every conjunct in its place
+def test_budget_fallback_chains_three_tables():
+    budget = main.Budget(nodes=1)
+    root = optimize_sql(
+        "SELECT E.Lname FROM Employee E, Works_On W, Department D "
+        "WHERE D.Dname = 'Research' AND E.Ssn = W.Essn AND E.Dno = D.Dnumber AND W.Hours > 10",
+        budget=budget)
+    assert budget.exceeded is not None
+    datas = all_datas(root)
+    assert "X" not in datas
+    assert "JOIN E.Ssn = W.Essn" in datas
+    assert "JOIN E.Dno = D.Dnumber" in datas
+    for tree_node in all_nodes(root):
+        if tree_node.data == "SELECT D.Dname = 'Research'":
+            assert tree_node.children[0].data == "Department AS D"
+        if tree_node.data == "SELECT W.Hours > 10":
+            assert tree_node.children[0].data == "Works_On AS W"
+    assert "SELECT D.Dname = 'Research'" in datas
+    assert "SELECT W.Hours > 10" in datas
@@ -0,0 +1,29 @@
+import glob
+import json
+import os
+
+import main
+from conftest import INPUTS
+
+BASELINE = os.path.join(os.path.dirname(__file__), "costs.json")
+
+
+# Every regression input has recorded costs and none of the plans got worse than them.
+# After a change that is meant to change the costs, record them again with
+# "python ../../main.py --record-costs ../costs.json *.txt" from tests/inputs
+def test_no_cost_regressions(monkeypatch):
+    monkeypatch.chdir(INPUTS)
+    files = sorted(glob.glob("*.txt"))
+    with open(BASELINE, "r") as file:
+        baseline = json.load(file)
+    assert sorted(baseline) == files
+    results = main.corpus_costs(files)
+    assert main.find_cost_regressions(results, baseline) == []
+
+
+# A plan more than COST_REGRESSION_THRESHOLD worse than its recorded cost is reported
+def test_regression_is_found():
+    baseline = {"q.txt": {stage: 100.0 for stage in main.COST_STAGES}}
+    worse = {"q.txt": {stage: 100.0 * (1 + main.COST_REGRESSION_THRESHOLD) + 1 for stage in main.COST_STAGES}}
+    assert main.find_cost_regressions(worse, baseline) == [("q.txt", 100.0, worse["q.txt"]["projections"])]
+    assert main.find_cost_regressions(baseline, baseline) == []
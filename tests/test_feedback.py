@@ -0,0 +1,38 @@
+import main
+
+ALIAS_MAP = {"P": "project", "E": "employee"}
+
+
+# A recorded selectivity is loaded back under the predicate's signature and used as its estimate
+def test_feedback_round_trip(tmp_path):
+    path = str(tmp_path / "feedback.db")
+    signature = main.predicate_signature("P.Pname = 'Aquarius'", ALIAS_MAP)
+    main.record_feedback(signature, 100, 20, 1000, path, now=0)
+    feedback = main.load_feedback(path, now=0)
+    assert feedback == {"'Aquarius' = project.pname": 0.02}
+    assert main.estimate_selectivity("SELECT P.Pname = 'Aquarius'", ALIAS_MAP, {}, feedback) == 0.02
+
+
+# Older observations count for less: after one half life the old one weighs half of the new one
+def test_feedback_decays_with_age(tmp_path):
+    path = str(tmp_path / "feedback.db")
+    main.record_feedback("s", 0, 100, 1000, path, now=0)
+    main.record_feedback("s", 0, 400, 1000, path, now=main.FEEDBACK_HALF_LIFE)
+    feedback = main.load_feedback(path, now=main.FEEDBACK_HALF_LIFE)
+    assert abs(feedback["s"] - (0.1 * 0.5 + 0.4) / 1.5) < 1e-9
+
+
+# An observation whose weight decayed below MIN_FEEDBACK_WEIGHT is ignored
+def test_stale_feedback_is_ignored(tmp_path):
+    path = str(tmp_path / "feedback.db")
+    main.record_feedback("s", 0, 100, 1000, path, now=0)
+    assert "s" in main.load_feedback(path, now=main.FEEDBACK_HALF_LIFE * 0.9)
+    assert "s" not in main.load_feedback(path, now=main.FEEDBACK_HALF_LIFE * 1.1)
+
+
+# String literals keep their case in signatures, names do not
+def test_signature_keeps_literal_case():
+    first = main.predicate_signature("P.Pname = 'Aquarius'", ALIAS_MAP)
+    second = main.predicate_signature("P.PNAME = 'AQUARIUS'", ALIAS_MAP)
+    assert first != second
+    assert first == main.predicate_signature("P.PNAME = 'Aquarius'", ALIAS_MAP)
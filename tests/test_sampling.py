@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import sqlglot
+
+import main
+
+
+# Writes a CSV data file with a header and returns its path
+def write_csv(directory, name, header, rows):
+    path = os.path.join(str(directory), name + ".csv")
+    with open(path, "w") as file:
+        file.write(header + "\n" + "".join(row + "\n" for row in rows))
+    return path
+
+
+# Returns the cache path load_samples uses for a data file
+def cache_path(path):
+    return os.path.join(os.path.dirname(path), main.SAMPLE_DIRECTORY, os.path.basename(path) + ".npz")
+
+
+# A file with more rows than SAMPLE_SIZE is reduced to SAMPLE_SIZE rows taken from the file
+def test_reservoir_sample_size(tmp_path):
+    path = write_csv(tmp_path, "t", "id,val", ["%d,%d" % (i, i % 7) for i in range(3000)])
+    columns, rows = main.csv_reservoir_sample(path, cache_path(path))
+    assert rows == 3000
+    assert len(columns["id"]) == main.SAMPLE_SIZE
+    assert len(set(columns["id"])) == main.SAMPLE_SIZE
+    assert all(int(i) % 7 == int(v) for i, v in zip(columns["id"], columns["val"]))
+
+
+# Empty cells and text in a number column are NULL: they match neither a condition nor its NOT
+def test_sample_mask_nulls():
+    sample = {"val": np.array(["1", "", "3", "x", " 5 ", "-2"])}
+    match, unknown = main.sample_mask(sqlglot.condition("T.val > 2"), sample)
+    assert list(match) == [False, False, True, False, True, False]
+    assert list(unknown) == [False, True, False, True, False, False]
+    match, unknown = main.sample_mask(sqlglot.condition("NOT T.val > 2"), sample)
+    assert list(match) == [True, False, False, False, False, True]
+
+
+# Rows appended to a CSV file are added to the cached sample without reading the file again
+def test_incremental_refresh_after_append(tmp_path):
+    path = write_csv(tmp_path, "t", "id", [str(i) for i in range(10)])
+    main.csv_reservoir_sample(path, cache_path(path))
+    with open(path, "a") as file:
+        file.write("10\n11\n")
+    columns, rows = main.csv_reservoir_sample(path, cache_path(path))
+    assert rows == 12
+    assert sorted(int(i) for i in columns["id"]) == list(range(12))
+    meta = main.load_sample_file(cache_path(path))[0]
+    assert meta["size"] == os.path.getsize(path)
+
+
+# A file edited in place before rows are appended is sampled again from the start
+def test_edit_in_place_is_detected(tmp_path):
+    path = write_csv(tmp_path, "t", "id", [str(i) for i in range(10)])
+    main.csv_reservoir_sample(path, cache_path(path))
+    write_csv(tmp_path, "t", "id", ["9"] + [str(i) for i in range(1, 12)])
+    columns, rows = main.csv_reservoir_sample(path, cache_path(path))
+    assert rows == 12
+    assert sorted(int(i) for i in columns["id"]) == [1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 10, 11]
+
+
+# The join size of two small files is their exact join size, every key is in the samples
+def test_sample_join_size(tmp_path):
+    write_csv(tmp_path, "a", "k", ["1", "1", "2", "3"])
+    write_csv(tmp_path, "b", "k", ["1", "2", "2", "4"])
+    catalog = {}
+    main.load_samples(catalog, str(tmp_path))
+    left, right = sqlglot.condition("A.k = B.k").this, sqlglot.condition("A.k = B.k").expression
+    assert main.sample_join_size(left, right, {"A": "a", "B": "b"}, catalog) == 4
+
+
+# A sample is moved into place from a temporary file that does not stay behind
+def test_save_sample_file_replaces(tmp_path):
+    path = str(tmp_path / main.SAMPLE_DIRECTORY / "t.csv.npz")
+    main.save_sample_file(path, {"rows": 1}, {"id": np.array(["1"])})
+    main.save_sample_file(path, {"rows": 2}, {"id": np.array(["1", "2"])})
+    assert main.load_sample_file(path)[0] == {"rows": 2}
+    assert os.listdir(os.path.dirname(path)) == ["t.csv.npz"]
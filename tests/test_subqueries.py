@@ -0,0 +1,78 @@
+from conftest import all_datas, all_nodes, optimize_input, optimize_sql
+
+
+# Returns the subquery join of a tree, checking there is only one
+def subquery_join(root, label):
+    nodes = [node for node in all_nodes(root) if str(node.data).startswith(label)]
+    assert len(nodes) == 1
+    return nodes[0]
+
+
+# IN becomes a semi join with the subquery's own selection in the subquery tree
+def test_in_becomes_semi_join():
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Ssn IN (SELECT W.Essn FROM Works_On W WHERE W.Hours > 10)")
+    join = subquery_join(root, "SEMI JOIN")
+    assert join.data == "SEMI JOIN E.Ssn = W.Essn"
+    assert "SELECT W.Hours > 10" in all_datas(join.children[1])
+    assert "IN (" not in " ".join(all_datas(root))
+
+
+# NOT EXISTS becomes an anti join on its correlated condition, NOT IN an anti join on the attribute
+def test_not_exists_and_not_in_become_anti_joins():
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE NOT EXISTS (SELECT * FROM Works_On W WHERE W.Essn = E.Ssn)")
+    assert subquery_join(root, "ANTI JOIN").data == "ANTI JOIN W.Essn = E.Ssn"
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Ssn NOT IN (SELECT W.Essn FROM Works_On W)")
+    assert subquery_join(root, "ANTI JOIN").data == "ANTI JOIN E.Ssn = W.Essn"
+
+
+# A correlated scalar aggregate becomes a join with the subquery grouped by its correlation keys
+def test_scalar_aggregate_becomes_aggregate_join():
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Salary > (SELECT AVG(S.Salary) FROM Employee S WHERE S.Dno = E.Dno)")
+    join = subquery_join(root, "AGGREGATE JOIN")
+    assert join.data == "AGGREGATE JOIN S.Dno = E.Dno AND E.Salary > AVG(S.Salary)"
+    assert "GROUP BY S.Dno" in all_datas(join.children[1])
+
+
+# An inner alias that is also an outer alias is renamed in the join condition and the subquery tree
+def test_colliding_aliases_are_renamed():
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Dno IN (SELECT E.Dno FROM Employee E WHERE E.Salary > 50000)")
+    join = subquery_join(root, "SEMI JOIN")
+    assert join.data == "SEMI JOIN E.Dno = A.Dno"
+    assert "Employee AS A" in all_datas(join.children[1])
+
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Salary > (SELECT AVG(E.Salary) FROM Employee E WHERE E.Dno = 5)")
+    join = subquery_join(root, "AGGREGATE JOIN")
+    assert join.data == "AGGREGATE JOIN E.Salary > AVG(A.Salary)"
+    assert "PROJECTION AVG(A.Salary)" in all_datas(join.children[1])
+
+
+# A subquery whose nested subquery uses the outer query is kept whole, its inner join could not see E
+def test_nested_reference_to_outer_query_is_kept_whole():
+    root = optimize_sql("SELECT E.Lname FROM Employee E WHERE E.Ssn IN (SELECT W.Essn FROM Works_On W WHERE W.Pno IN (SELECT P.Pnumber FROM Project P WHERE P.Dnum = E.Dno))")
+    datas = all_datas(root)
+    assert not any(data.startswith("SEMI JOIN") for data in datas)
+    assert [data for data in datas if data.startswith("FILTER")] == ["FILTER E.Ssn IN (SELECT W.Essn FROM Works_On AS W WHERE W.Pno IN (SELECT P.Pnumber FROM Project AS P WHERE P.Dnum = E.Dno))"]
+
+
+# A subquery under an OR is kept whole instead of being split on SELECT and AND
+def test_subquery_under_or():
+    datas = all_datas(optimize_input("subquery_or.txt"))
+    assert "FILTER E.Ssn IN (SELECT W.Essn FROM Works_On AS W) OR E.Salary > 5000" in datas
+    assert not any(data.startswith("SELECT") and "IN (" in data for data in datas)
+    assert "X" not in datas
+
+
+# A COUNT subquery is not unnested and does not reach the selection steps
+def test_nested_count():
+    datas = all_datas(optimize_input("nested_count.txt"))
+    assert "FILTER (SELECT COUNT(*) FROM Works_On AS W WHERE W.Essn = E.Ssn) > 2" in datas
+
+
+# A subquery correlated with two outer tables goes above their join, the cartesian still becomes a join
+def test_correlated_subquery_over_two_outer_tables():
+    costs = {}
+    root = optimize_input("two_outer_tables.txt", costs)
+    assert "X" not in all_datas(root)
+    join = subquery_join(root, "SEMI JOIN")
+    assert str(join.children[0].data) == "JOIN E.Dno = D.Dnumber"
+    assert costs["projections"] <= costs["canonical"]